@@ -5,66 +5,234 @@ from __future__ import division, print_function
 
 import numpy as np
 import numpy.ma as ma
+import scipy.sparse as sp
 
-def entropy(probabilities_x):
+def _check_probabilities(probabilities):
+    '''Asserts that 0 <= x <= 1 for every probability (dense or sparse)'''
+    if sp.issparse(probabilities):
+        probabilities = probabilities.data
+
+    if probabilities.size:
+        assert probabilities.min() >= 0 and probabilities.max() <= 1
+
+def _plogp(probabilities):
+    '''
+    Computes p * log2(p) for every value, zero where p is zero. Only the
+    stored values of sparse matrices are touched.
+    '''
+    if sp.issparse(probabilities):
+        probabilities = probabilities.data
+
+    terms = np.zeros(probabilities.shape)
+    np.log2(probabilities, out=terms, where=probabilities != 0)
+    terms *= probabilities
+    return terms
+
+def entropy(probabilities_x, axis=None):
     '''
     Calculates the entropy (H) of the input vector which
     represents some random variable X.
 
+    When `axis` is given the input is taken as a batch of distributions
+    (e.g., one per row of a 2-D array or of a `scipy.sparse` matrix) and
+    the entropy of each one is computed in a single vectorized pass.
+    Sparse matrices are never densified, only their non-zero values are
+    used.
+
     Parameters
     ----------
-    probabilities_x: numpy array or any iterable
+    probabilities_x: numpy array, scipy.sparse matrix or any iterable
         Array with the individual probabilities_x. Values must be 0 <= x <=1
+
+    axis: int or None
+        Axis along which the distributions lie, (e.g., 1 for one
+        distribution per row). None computes a single entropy over all
+        values.
     '''
-    probabilities_x = np.asanyarray(probabilities_x)
-    
-    assert (probabilities_x >= 0).all() and (probabilities_x <= 1).all()
+    if sp.issparse(probabilities_x):
+        probabilities_x = probabilities_x.tocsr()
+    else:
+        probabilities_x = np.asanyarray(probabilities_x)
 
-    probabilities_x = probabilities_x[probabilities_x != 0]
+    _check_probabilities(probabilities_x)
 
-    return -1 * (probabilities_x * np.log2(probabilities_x)).sum()
+    if axis is None:
+        #a single distribution, summing only the non zeros keeps the
+        #summation order of the scalar case
+        if not sp.issparse(probabilities_x):
+            probabilities_x = probabilities_x[probabilities_x != 0]
+        return -1 * _plogp(probabilities_x).sum()
 
-def mutual_information(probabilities_x, probabilities_xy):
+    terms = _plogp(probabilities_x)
+
+    if sp.issparse(probabilities_x):
+        terms = sp.csr_matrix((terms, probabilities_x.indices,
+                               probabilities_x.indptr),
+                              shape=probabilities_x.shape)
+        return -1 * np.asarray(terms.sum(axis=axis)).ravel()
+
+    return -1 * terms.sum(axis=axis)
+
+def mutual_information(probabilities_x, probabilities_xy, axis=None):
     '''
     Calculates the mutual information between the
     random variables (X and X|Y):
 
     Parameters
     ----------
-    probabilities_x: numpy array or any iterable
+    probabilities_x: numpy array, scipy.sparse matrix or any iterable
         Array with the individual probabilities X. Values must be 0 <= x <= 1
 
-    probabilities_xy: numpy array or any iterable
+    probabilities_xy: numpy array, scipy.sparse matrix or any iterable
         Array with the individual probabilities for X|Y. Values must be 0 <= x <= 1
+
+    axis: int or None
+        Axis along which the distributions lie, see `entropy`
     '''
 
-    h_x = entropy(probabilities_x)
-    h_xy = entropy(probabilities_xy)
+    h_x = entropy(probabilities_x, axis)
+    h_xy = entropy(probabilities_xy, axis)
     return h_x - h_xy
 
-def norm_mutual_information(probabilities_x, probabilities_xy):
+def norm_mutual_information(probabilities_x, probabilities_xy, axis=None):
     '''
     Calculates the normalized mutual information between the
     random variables (X and X|Y):
 
     Parameters
     ----------
-    probabilities_x: numpy array or any iterable
+    probabilities_x: numpy array, scipy.sparse matrix or any iterable
         Array with the individual probabilities X. Values must be 0 <= x <= 1
 
-    probabilities_xy: numpy array or any iterable
+    probabilities_xy: numpy array, scipy.sparse matrix or any iterable
         Array with the individual probabilities for X|Y. Values must be 0 <= x <= 1
+
+    axis: int or None
+        Axis along which the distributions lie, see `entropy`
     '''
 
-    h_x = entropy(probabilities_x)
-    h_xy = entropy(probabilities_xy)
+    h_x = entropy(probabilities_x, axis)
+    h_xy = entropy(probabilities_xy, axis)
+
+    if np.ndim(h_x) == 0 and np.ndim(h_xy) == 0:
+        normalized_mi = 0
+        if h_x > 0 and h_xy > 0:
+            normalized_mi = 1 - (h_x - h_xy) / h_x
+
+        return normalized_mi
+
+    #distributions with zero entropy have a normalized mi of zero
+    h_x, h_xy = np.broadcast_arrays(h_x, h_xy)
+    defined = (h_x > 0) & (h_xy > 0)
 
-    normalized_mi = 0
-    if h_x > 0 and h_xy > 0:
-        normalized_mi = 1 - (h_x - h_xy) / h_x
-        
+    normalized_mi = np.zeros(h_x.shape)
+    normalized_mi[defined] = \
+            1 - (h_x[defined] - h_xy[defined]) / h_x[defined]
     return normalized_mi
 
+class StreamingEntropy(object):
+    '''
+    Incremental entropy estimator over a stream of counts. Only the
+    sufficient statistics are kept, the total count N and the sum of
+    n * log2(n) over categories (S), so that the entropy of the
+    distribution seen so far is available in O(1):
+
+    $$ H = log2(N) - S / N $$
+
+    Counts for the same category may arrive in different chunks when a
+    category key is given; in this case the current count of every
+    keyed category is kept to update S. Anonymous counts (no keys) are
+    taken as new distinct categories and need no memory. Estimators
+    from different workers can be combined with `merge`.
+    '''
+
+    def __init__(self):
+        self.total = 0
+        self.sum_nlogn = 0.0
+        self.counts = {}
+
+    def add_counts(self, counts, categories=None):
+        '''
+        Adds a chunk of counts to the estimator.
+
+        Parameters
+        ----------
+        counts: numpy array or any iterable
+            Array with the number of events of each category. Values must
+            be >= 0
+
+        categories: numpy array or any iterable
+            Keys of the categories of each count. When None every count
+            is taken as a new category, never seen before
+        '''
+        counts = np.asanyarray(counts, dtype='d')
+        assert counts.size == 0 or counts.min() >= 0
+
+        if categories is None:
+            self.total += counts.sum()
+            self.sum_nlogn += _plogp(counts).sum()
+            return self
+
+        categories = np.asanyarray(categories)
+        assert categories.shape == counts.shape
+
+        #the same key may appear more than once in a chunk
+        categories, position = np.unique(categories, return_inverse=True)
+        counts = np.bincount(position, weights=counts,
+                             minlength=len(categories))
+
+        previous = np.array([self.counts.get(key, 0) for key in
+                             categories.tolist()], dtype='d')
+        current = previous + counts
+
+        self.total += counts.sum()
+        self.sum_nlogn += (_plogp(current) - _plogp(previous)).sum()
+        self.counts.update(zip(categories.tolist(), current.tolist()))
+        return self
+
+    def add_events(self, events):
+        '''
+        Adds a chunk of raw categorical events (e.g., the ids of the
+        videos viewed) to the estimator.
+
+        Parameters
+        ----------
+        events: numpy array or any iterable
+            Array with the category of each event
+        '''
+        categories, counts = np.unique(np.asanyarray(events),
+                                       return_counts=True)
+        return self.add_counts(counts, categories)
+
+    def merge(self, other):
+        '''
+        Merges the statistics of another estimator into this one. Keyed
+        categories present in both have their counts summed.
+
+        Parameters
+        ----------
+        other: StreamingEntropy
+            Estimator to merge, it is left unchanged
+        '''
+        self.total += other.total
+        self.sum_nlogn += other.sum_nlogn
+
+        for key, count in other.counts.items():
+            previous = self.counts.get(key, 0)
+            if previous:
+                terms = _plogp(np.array([previous + count, previous, count]))
+                self.sum_nlogn += terms[0] - terms[1] - terms[2]
+            self.counts[key] = previous + count
+        return self
+
+    def entropy(self):
+        '''Returns the entropy (H) of the counts seen so far'''
+        if self.total == 0:
+            return 0.0
+
+        #rounding may leave a tiny negative value for a single category
+        return max(np.log2(self.total) - self.sum_nlogn / self.total, 0.0)
+
 def kullback_leiber_divergence(probabilities_p, probabilities_q):
     '''
     Calculates the Kullback-Leiber divergence between the distributions
@@ -89,14 +257,137 @@ def kullback_leiber_divergence(probabilities_p, probabilities_q):
     non_zero_p = probabilities_p != 0
     non_zero_q = probabilities_q != 0
     
-    #n * log(n / 0) = inf (definition of kullback leiber)
-    #by subtracting boolean arrays, we need an zero array for equality
-    if (non_zero_p - non_zero_q).any():
+    #n * log(n / 0) = inf (definition of kullback leiber), while
+    #0 * log(0 / n) = 0, so only zeros of q where p is non zero matter
+    if (non_zero_p & ~non_zero_q).any():
         return np.inf
     
-    #from here we know that non_zero_x == non_zero_y
-    probabilities_p = probabilities_p[non_zero_p != 0]
-    probabilities_q = probabilities_q[non_zero_q != 0]
+    #from here we know that q is non zero wherever p is
+    probabilities_p = probabilities_p[non_zero_p]
+    probabilities_q = probabilities_q[non_zero_p]
 
     log_part = np.log2(probabilities_p) - np.log2(probabilities_q)
     return (probabilities_p * log_part).sum()
+
+def _block_size(num_rows, num_values, block_size, divergence):
+    '''
+    Number of distributions per block, by default chosen so that the
+    temporary arrays of a block have about 2 ** 22 values. These are
+    (block, num_rows) matrices for KL and (block, block, num_values)
+    arrays for JS.
+    '''
+    if block_size is not None:
+        return block_size
+
+    if divergence == 'js':
+        return max(1, int(np.sqrt(2 ** 22 / max(num_values, 1))))
+    return max(1, 2 ** 22 // max(num_rows, 1))
+
+def _kl_matrix(probabilities, out, block_size):
+    '''Fills `out` with the KL divergence of every pair of rows'''
+    #sum p * log2(p) of each row, the cross term is a matrix product
+    neg_entropies = _plogp(probabilities).sum(axis=1)
+
+    #log2(0) is left as zero, those pairs are marked as inf below
+    non_zero = probabilities != 0
+    log_q = np.zeros(probabilities.shape)
+    np.log2(probabilities, out=log_q, where=non_zero)
+    zero_q = (~non_zero).astype('d')
+
+    for start in range(0, len(probabilities), block_size):
+        rows = slice(start, start + block_size)
+        block = neg_entropies[rows, np.newaxis] - \
+                np.dot(probabilities[rows], log_q.T)
+
+        #p(x) > 0 where q(x) = 0 on any x diverges
+        block[np.dot(non_zero[rows].astype('d'), zero_q.T) > 0] = np.inf
+
+        #rounding may leave tiny values, D(P || P) is 0
+        np.maximum(block, 0, out=block)
+        block_rows = np.arange(block.shape[0])
+        block[block_rows, start + block_rows] = 0
+        out[rows] = block
+
+def _js_matrix(probabilities, out, block_size):
+    '''Fills `out` with the JS divergence of every pair of rows'''
+    #JS(P || Q) = H(M) - (H(P) + H(Q)) / 2, with M = (P + Q) / 2
+    entropies = -1 * _plogp(probabilities).sum(axis=1)
+
+    num_rows = len(probabilities)
+    for i in range(0, num_rows, block_size):
+        rows = slice(i, i + block_size)
+        for j in range(i, num_rows, block_size):
+            cols = slice(j, j + block_size)
+
+            mixture = probabilities[rows, np.newaxis] + \
+                    probabilities[np.newaxis, cols]
+            mixture /= 2
+
+            block = -1 * _plogp(mixture).sum(axis=2)
+            block -= (entropies[rows, np.newaxis] +
+                      entropies[np.newaxis, cols]) / 2
+
+            #rounding may leave tiny values, JS(P || P) is 0
+            np.maximum(block, 0, out=block)
+            if i == j:
+                np.fill_diagonal(block, 0)
+
+            #the divergence is symmetric, only upper blocks are computed
+            out[rows, cols] = block
+            out[cols, rows] = block.T
+
+def pairwise_divergence(probabilities, divergence='kl', block_size=None,
+                        out_path=None):
+    '''
+    Calculates the divergence between every pair of distributions (rows)
+    of the input. The result is computed in blocks of rows with
+    vectorized operations, so only the output matrix and temporaries of
+    a block are kept in memory. For large inputs, the output may be a
+    memory mapped file.
+
+    The Kullback-Leiber matrix has D[i, j] = D_{kl}(P_i || P_j), which is
+    inf when P_i is non zero where P_j is zero. The Jensen-Shannon
+    divergence is symmetric and bounded by 1.
+
+    Parameters
+    ----------
+    probabilities: numpy array (n, k) or any iterable
+        Matrix with one distribution per row. Values must be 0 <= x <= 1
+
+    divergence: 'kl' or 'js'
+        Either the Kullback-Leiber or the Jensen-Shannon divergence
+
+    block_size: int or None
+        Number of distributions per block. The Kullback-Leiber temporaries
+        grow with block_size * n, the Jensen-Shannon ones with
+        block_size ** 2 * k. None picks a size based on these
+
+    out_path: str or None
+        If given, the (n, n) result is written to this .npy file, which
+        is memory mapped, and returned as a numpy.memmap
+    '''
+    probabilities = np.asanyarray(probabilities, dtype='d')
+    assert probabilities.ndim == 2
+    _check_probabilities(probabilities)
+
+    if divergence == 'kl':
+        fill = _kl_matrix
+    elif divergence == 'js':
+        fill = _js_matrix
+    else:
+        raise ValueError('Unknown divergence %s' % divergence)
+
+    num_rows, num_values = probabilities.shape
+    block_size = _block_size(num_rows, num_values, block_size, divergence)
+
+    if out_path is None:
+        out = np.zeros((num_rows, num_rows))
+    else:
+        out = np.lib.format.open_memmap(out_path, mode='w+', dtype='d',
+                                        shape=(num_rows, num_rows))
+
+    fill(probabilities, out, block_size)
+
+    if out_path is not None:
+        out.flush()
+    return out
@@ -7,13 +7,54 @@ from __future__ import division, print_function
 
 from abc import abstractmethod
 from abc import ABCMeta
+from collections import deque
+from itertools import chain
+from itertools import islice
+from operator import itemgetter
 from multiprocessing import Pool
+from multiprocessing import Process
+from multiprocessing import Queue
+from multiprocessing.connection import Client
+from multiprocessing.connection import Listener
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
 
 import argparse
+import bisect
 import cProfile as profile
+import glob
+import gzip
+import hashlib
+import heapq
+import importlib
+import inspect
+import json
+import math
+import numpy as np
+import os
+import pickle
 import pstats
+import shutil
+import socket
 import sys
+import tempfile
+import threading
+import time
 import traceback
+import zlib
+
+try:
+    import queue
+except ImportError: #python 2
+    import Queue as queue
+
+try:
+    import asyncio
+except ImportError: #python 2
+    asyncio = None
+
+#Pools used by each backend, see `Runner._go`
+_POOLS = {'process' : Pool, 'thread' : ThreadPool}
 
 class BaseMapper(object):
     '''This class can be used to
@@ -21,6 +62,10 @@ class BaseMapper(object):
 
     __metaclass__ = ABCMeta
     
+    #Results cached with --cache_dir are only reused by mappers of the same
+    #class and version, change it when the code or parameters change
+    version = None
+    
     @abstractmethod
     def _map(self, key, item):
         '''
@@ -34,6 +79,33 @@ class BaseMapper(object):
     def __call__(self, key, item):
         return self._map(key, item)
 
+class BaseBatchMapper(BaseMapper):
+    '''This class can be used to
+       safely create Mappers which work on batches of items'''
+    
+    #If True, the items of a batch are stacked in a numpy array
+    stack_items = False
+    
+    @abstractmethod
+    def _map_batch(self, keys, items):
+        '''
+        This method is wrapped by the `map_batch`
+        method. It receives a sequence of keys and the
+        corresponding items (a numpy array if `stack_items`
+        is True) and must return a sequence with one value
+        for each key, in the same order.
+        '''
+        pass
+    
+    def _map(self, key, item):
+        return self.map_batch([key], [item])[0]
+    
+    def map_batch(self, keys, items):
+        '''Maps a batch of items, returns one value per key'''
+        if self.stack_items:
+            items = np.asarray(items)
+        return self._map_batch(keys, items)
+
 class BaseReducer(object):
     '''This class can be used to
        safely create Reducers'''
@@ -53,6 +125,26 @@ class BaseReducer(object):
     def __call__(self, key, item):
         return self._reduce(key, item)
 
+class BaseCombiner(object):
+    '''This class can be used to
+       safely create Combiners'''
+
+    __metaclass__ = ABCMeta
+    
+    @abstractmethod
+    def _combine(self, key, values):
+        '''
+        This method is wrapped by the __call__
+        method. It receives a list with the values mapped
+        for a key inside one chunk of items and must return a
+        single value which partially aggregates them. This
+        value is what the reducer will receive.
+        '''
+        pass
+    
+    def __call__(self, key, values):
+        return self._combine(key, values)
+
 class Runner(object):
     '''
     This class can be used to create programs which work
@@ -64,9 +156,62 @@ class Runner(object):
     scripts. They make use of the `argparse` module for configuration.
     By default, each runner has the following arguments:
        * num_procs : The number of processes to use
-       * --profile (optional) : If execution should be profiled
+       * --profile (optional) : If execution should be profiled. Every 
+         process is profiled and the results are merged
+       * --backend (optional) : How items are mapped in parallel, with 
+         processes (default), threads, coroutines (asyncio), serially or
+         by slaves in other machines (remote, see `run_worker`)
+       * --coordinator (optional) : Address where the remote backend waits
+         for slaves
+       * --authkey (optional) : Key shared with the remote slaves
+       * --chunk_size (optional) : Number of items sent to a process at once,
+         or `auto` to tune it based on the measured cost of each item
+       * --mapper_per_item (optional) : Pickles the mapper with every item
+         instead of installing it once in each process
+       * --batch_size (optional) : Number of items grouped for batch
+         mappers and combiners
+       * --num_reducers (optional) : Number of reducer processes, map 
+         results are hash partitioned by key among them
+       * --max_in_flight (optional) : Maximum number of items sent to 
+         the processes but not yet reduced
+       * --max_in_flight_bytes (optional) : Same as above, but limits the
+         (pickled) size of the items
+       * --spill_after (optional) : Number of mapped values kept in memory
+         before being spilled to disk. Values are then reduced in key order
+       * --spill_dir (optional) : Directory for the spilled values
+       * --checkpoint (optional) : File where the reduction state and the
+         number of items processed are periodically saved
+       * --checkpoint_every (optional) : Items between checkpoints
+       * --resume (optional) : Resumes from the checkpoint file
+       * --retries (optional) : Number of times an item is mapped again
+         after the mapper raises an exception
+       * --quarantine (optional) : File where items which still fail are
+         saved (see `read_quarantine`), they are not reduced
+       * --max_failures (optional) : Number of failed items tolerated
+       * --max_tasks_per_worker (optional) : Processes are replaced after
+         mapping this number of tasks (items or batches)
+       * --max_worker_memory (optional) : Processes are replaced once one
+         of them uses more than this memory (in MB)
+       * --cache_dir (optional) : Directory where mapped values are kept,
+         items mapped by previous runs are not mapped again
+       * --cache_max_bytes (optional) : Maximum size of the cache
+       * --speculate (optional) : Tasks slower than this many times the
+         median are mapped again by another process (stragglers)
+       * --progress (optional) : Periodically prints the items mapped,
+         the throughput and an ETA
+       * --progress_every (optional) : Seconds between progress reports
+       * --total_items (optional) : Number of items used for the ETA,
+         instead of `total_items`
+       * --stats (optional) : Periodically prints throughput and latency
+         counters of each stage
+       * --stats_file (optional) : Appends the counters to this file as
+         JSON lines instead
+       * --stats_every (optional) : Seconds between counter reports
     Other arguments are defined by inheritance.
     
+    Items come from `item_generator`, or are read by the slave processes
+    from the splits returned by `input_splits` (see `read_split`).
+    
     The code runs as follows:
         1. creates a argparse with default arguments
         2. adds custom arguments with the `add_custom_aguments`
@@ -79,6 +224,10 @@ class Runner(object):
     '''
     __metaclass__ = ABCMeta
     
+    #Set by `Pipeline`: the items of this stage and where to emit results
+    _input = None
+    _sink = None
+    
     def __init__(self, name, description):
         self.name = name
         self.description = description
@@ -92,6 +241,34 @@ class Runner(object):
         '''
         pass
     
+    def input_splits(self):
+        '''
+        Optional. May return a list of input splits, such as file paths or
+        (path, start, end) byte ranges. When splits are given, 
+        `item_generator` is not used. Each split is sent to a slave process
+        which reads its items with `read_split`, so the master does not 
+        read or parse the input. The default implementation returns None.
+        '''
+        return None
+    
+    def total_items(self):
+        '''
+        Optional. May return the number of items of the run, or an 
+        estimate, used for the ETA of `--progress`. For line based input
+        files, `estimate_lines` estimates it from the size of the files. 
+        The default implementation returns None (no ETA).
+        '''
+        return None
+    
+    def read_split(self, split):
+        '''
+        Used with `input_splits`. Must return a generator or iterator which
+        yields the (key, item) tuples of the split. It is called in the 
+        slave processes, where the runner was copied when they started.
+        '''
+        raise NotImplementedError('read_split must be inherited with '
+                                  'input_splits')
+    
     @abstractmethod
     def mapper(self):
         '''
@@ -106,7 +283,8 @@ class Runner(object):
         this class does not work with lambdas or class methods.
 
         The safest way to create a reducer is to inherit
-        `BaseMapper`
+        `BaseMapper`. Mappers which inherit `BaseBatchMapper` will
+        receive items in batches of `--batch_size`.
         '''
         pass
     
@@ -126,6 +304,79 @@ class Runner(object):
         '''
         pass
     
+    def combiner(self):
+        '''
+        Optional. May return a `Callable` which receives a key and
+        the list of values mapped for that key inside a chunk of items,
+        returning a single partially aggregated value.
+        
+        When a combiner is given, each slave maps a whole chunk of items,
+        combines the values per key and only the combined values are
+        sent to the reducer. The reducer must thus be able to reduce
+        combined values. For example:
+        
+        comb = self.combiner()
+        partial = comb(key, [value_1, value_2])
+        reduc = self.reducer()
+        reduc(key, partial)
+        
+        The safest way to create a combiner is to inherit
+        `BaseCombiner`. The default implementation returns None, meaning
+        no combining is done.
+        '''
+        return None
+    
+    def reducer_state(self, reducer):
+        '''
+        Used when reduction is partitioned (`--num_reducers` > 1). It is
+        called inside each reducer process after all of the values of the
+        partition were reduced, and must return a picklable object with the
+        state of the partition. This object is sent to `merge_partitions`.
+        
+        By default the reducer itself is returned, which works for
+        `BaseReducer` subclasses keeping their state as attributes. 
+        Closures cannot be pickled, so runners using them must
+        inherit this method.
+        '''
+        return reducer
+    
+    def checkpoint_state(self, reducer):
+        '''
+        Used when checkpoints are saved (`--checkpoint`). Must return a 
+        picklable object with the state of the reduction so far. By default
+        the result of `reducer_state` is returned.
+        '''
+        return self.reducer_state(reducer)
+    
+    def restore_state(self, state):
+        '''
+        Used when a job is resumed (`--resume`). Receives the object 
+        returned by `checkpoint_state` and must restore the state of the
+        reduction, returning the reducer to be used from then on. By default
+        the state is assumed to be the reducer itself.
+        '''
+        return state
+    
+    def merge_partitions(self, states):
+        '''
+        Inherit this method to merge the states of each reducer partition.
+        It receives a list with the result of `reducer_state` for every
+        partition (in partition order) and is called before `finalize`.
+        This method is only used when `--num_reducers` > 1.
+        '''
+        pass
+    
+    def emit(self, key, item):
+        '''
+        Sends a (key, item) tuple to the next stage of a `Pipeline`, it will
+        be one of the items mapped by that stage. Should be called by the
+        reducer, `merge_partitions` or `finalize`, since tuples emitted by
+        other processes are lost. Outside of a pipeline, or in its last 
+        stage, tuples emitted are ignored.
+        '''
+        if self._sink is not None:
+            self._sink(key, item)
+    
     def add_custom_aguments(self, parser):
         '''
         Inherit this method to add custom arguments to
@@ -159,7 +410,13 @@ class Runner(object):
         '''
         pass
 
-    def __call__(self, args = None):
+    def __call__(self, args = None, pool = None):
+        '''
+        Runs the script with the command line arguments in `args`. A
+        `WorkerPool` may be given in `pool`, its processes are then used 
+        to map the items instead of creating new ones. Returns True if
+        the run was successful.
+        '''
         if not args: 
             args = []
         
@@ -170,8 +427,99 @@ class Runner(object):
                                 help='Number or parallel processors')
             parser.add_argument('--profile',  action='store_true', 
                                 help='Profile the execution?')
-            parser.add_argument('--chunk_size', type=int, 
-                                help='Overwrite default chunk size (100)')
+            parser.add_argument('--backend', default='process',
+                                choices=['process', 'thread', 'asyncio', 
+                                         'serial', 'remote'],
+                                help='Execution backend (process)')
+            parser.add_argument('--coordinator', type=_address,
+                                help='host:port where the remote backend '
+                                     'waits for slaves')
+            parser.add_argument('--authkey', type=str,
+                                default=os.environ.get('VOD_AUTHKEY'),
+                                help='Authentication key of remote slaves '
+                                     '(VOD_AUTHKEY)')
+            parser.add_argument('--chunk_size', type=_chunk_size, 
+                                help='Overwrite default chunk size (100), '
+                                     'use auto to tune it during the run')
+            parser.add_argument('--mapper_per_item', action='store_true', 
+                                help='Send the mapper with every item '
+                                     'instead of once per process')
+            parser.add_argument('--batch_size', type=int, 
+                                help='Number of items grouped for batch '
+                                     'mappers and combiners (defaults to '
+                                     'the chunk size or 100)')
+            parser.add_argument('--num_reducers', type=int, default=1,
+                                help='Number of reducer processes (1)')
+            parser.add_argument('--ordered', action='store_true',
+                                help='Reduce results in generator order')
+            parser.add_argument('--reorder_buffer', type=int, default=10000,
+                                help='Maximum number of mapped items '
+                                     'waiting for earlier ones in ordered '
+                                     'mode (10000)')
+            parser.add_argument('--max_in_flight', type=int,
+                                help='Maximum number of items being mapped')
+            parser.add_argument('--max_in_flight_bytes', type=int,
+                                help='Maximum size in bytes of the items '
+                                     'being mapped')
+            parser.add_argument('--spill_after', type=int,
+                                help='Spill mapped values to disk after '
+                                     'this many are kept in memory, and '
+                                     'reduce them in key order')
+            parser.add_argument('--spill_dir', type=str,
+                                help='Directory for spilled values '
+                                     '(system default)')
+            parser.add_argument('--checkpoint', type=str,
+                                help='File to periodically save the state '
+                                     'of the reduction')
+            parser.add_argument('--checkpoint_every', type=int, 
+                                default=100000,
+                                help='Number of items between checkpoints '
+                                     '(100000)')
+            parser.add_argument('--resume', action='store_true',
+                                help='Resume from the checkpoint file')
+            parser.add_argument('--retries', type=int, default=0,
+                                help='Times to retry items which fail (0)')
+            parser.add_argument('--quarantine', type=str,
+                                help='File to save the items which fail')
+            parser.add_argument('--max_failures', type=int,
+                                help='Number of failed items tolerated')
+            parser.add_argument('--max_tasks_per_worker', type=int,
+                                help='Replace processes after this many '
+                                     'tasks')
+            parser.add_argument('--max_worker_memory', type=float,
+                                help='Replace processes once one uses more '
+                                     'than this many MB')
+            parser.add_argument('--share_arrays_above', type=int,
+                                help='Send mapped numpy arrays of at least '
+                                     'this many bytes through memory '
+                                     'mapped files')
+            parser.add_argument('--share_dir', type=str,
+                                help='Directory for shared arrays '
+                                     '(/dev/shm if available)')
+            parser.add_argument('--cache_dir', type=str,
+                                help='Directory where mapped values are '
+                                     'cached for later runs')
+            parser.add_argument('--cache_max_bytes', type=int,
+                                help='Evict the least recently used cached '
+                                     'values above this size')
+            parser.add_argument('--speculate', type=float,
+                                help='Map again tasks taking more than '
+                                     'this many times the median task time')
+            parser.add_argument('--progress', action='store_true',
+                                help='Periodically report the progress '
+                                     'and an ETA')
+            parser.add_argument('--progress_every', type=float, default=10,
+                                help='Seconds between progress reports (10)')
+            parser.add_argument('--total_items', type=int,
+                                help='Number of items (or an estimate) for '
+                                     'the ETA, overrides total_items')
+            parser.add_argument('--stats', action='store_true',
+                                help='Report counters of each stage')
+            parser.add_argument('--stats_file', type=str,
+                                help='Write the counters as JSON lines to '
+                                     'this file')
+            parser.add_argument('--stats_every', type=float, default=10,
+                                help='Seconds between counter reports (10)')
                                     
             self.add_custom_aguments(parser)
             arg_vals = parser.parse_args(args)
@@ -179,75 +527,2895 @@ class Runner(object):
             
             num_procs = arg_vals.num_procs
             chunk_size = arg_vals.chunk_size
+            options = dict(backend = arg_vals.backend,
+                           coordinator = arg_vals.coordinator,
+                           authkey = arg_vals.authkey,
+                           worker_pool = pool,
+                           install_mapper = not arg_vals.mapper_per_item,
+                           batch_size = arg_vals.batch_size,
+                           num_reducers = arg_vals.num_reducers,
+                           ordered = arg_vals.ordered,
+                           reorder_buffer = arg_vals.reorder_buffer,
+                           max_in_flight = arg_vals.max_in_flight,
+                           max_in_flight_bytes = arg_vals.max_in_flight_bytes,
+                           spill_after = arg_vals.spill_after,
+                           spill_dir = arg_vals.spill_dir,
+                           checkpoint = arg_vals.checkpoint,
+                           checkpoint_every = arg_vals.checkpoint_every,
+                           resume = arg_vals.resume,
+                           retries = arg_vals.retries,
+                           quarantine = arg_vals.quarantine,
+                           max_failures = arg_vals.max_failures,
+                           max_tasks_per_worker = 
+                                   arg_vals.max_tasks_per_worker,
+                           max_worker_memory = arg_vals.max_worker_memory,
+                           share_arrays_above = arg_vals.share_arrays_above,
+                           share_dir = arg_vals.share_dir,
+                           cache_dir = arg_vals.cache_dir,
+                           cache_max_bytes = arg_vals.cache_max_bytes,
+                           speculate = arg_vals.speculate,
+                           progress = arg_vals.progress,
+                           progress_every = arg_vals.progress_every,
+                           total_items = arg_vals.total_items,
+                           stats = arg_vals.stats or bool(arg_vals.stats_file),
+                           stats_file = arg_vals.stats_file,
+                           stats_every = arg_vals.stats_every)
             if arg_vals.profile: #will profile and summarize using pstats
                 print('saving profiler output to: .run_profile.prof',
                       file = sys.stderr)
                 
-                profile.runctx('self._go(num_procs, chunk_size)', 
+                #slaves save to .run_profile.worker-<pid>.prof
+                for path in glob.glob('.run_profile.worker-*.prof'):
+                    os.remove(path)
+                options['profile_prefix'] = '.run_profile'
+                
+                profile.runctx('self._go(num_procs, chunk_size, **options)', 
                                globals(), locals(), '.run_profile.prof')
                 
-                stats = pstats.Stats('.run_profile.prof').\
-                        strip_dirs().sort_stats('time')
+                stats = pstats.Stats('.run_profile.prof')
+                worker_paths = glob.glob('.run_profile.worker-*.prof')
+                for path in worker_paths:
+                    stats.add(path)
+                
+                if worker_paths:
+                    print('merged profiles of %d processes in: '
+                          '.run_profile.all.prof' % (len(worker_paths) + 1),
+                          file = sys.stderr)
+                    stats.dump_stats('.run_profile.all.prof')
+                
+                stats.strip_dirs().sort_stats('time')
                 stats.print_stats()
             else: #normal execution
-                self._go(num_procs, chunk_size)
+                self._go(num_procs, chunk_size, **options)
             
+            return True
         except Exception:
             parser.print_help(file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
+            return False
     
-    def _go(self, num_procs, chunk_size = None):
+    def _go(self, num_procs, chunk_size = None, backend = 'process', 
+            coordinator = None, authkey = None, worker_pool = None, 
+            install_mapper = True, batch_size = None, num_reducers = 1, 
+            ordered = False, reorder_buffer = 10000, max_in_flight = None,
+            max_in_flight_bytes = None, spill_after = None, 
+            spill_dir = None, checkpoint = None, checkpoint_every = 100000,
+            resume = False, retries = 0, quarantine = None, 
+            max_failures = None, max_tasks_per_worker = None, 
+            max_worker_memory = None, share_arrays_above = None,
+            share_dir = None, cache_dir = None, cache_max_bytes = None,
+            speculate = None, progress = False, progress_every = 10,
+            total_items = None, stats = False, stats_file = None, 
+            stats_every = 10, profile_prefix = None):
         '''
         This is the equivalent of the main method. It will 
         create the processes and the pipeline between item generators -> 
         mappers -> a reducer.
+        
+        The `backend` defines how items are mapped when `num_procs` > 1:
+            * process : a pool of `num_procs` processes
+            * thread : a pool of `num_procs` threads, nothing is pickled
+            * asyncio : the mapper may return coroutines, which are run with
+              at most `num_procs` of them at once (see `_run_coroutines`),
+              also when `num_procs` is 1
+            * serial : every item is mapped by the master
+            * remote : slaves in other machines connect to `coordinator`
+              with the `authkey` given (see `run_worker`)
+        
+        With the remote backend, `num_procs` is only used to size buffers
+        and items are always mapped by the remote slaves, in chunks of 100
+        items unless a `chunk_size` is given. Tasks are sent again if a 
+        slave disconnects (see `_Coordinator`).
+        
+        A `worker_pool` may be given to the process backend, its processes
+        are used instead of `num_procs` new ones (see `WorkerPool`).
+        
+        If `install_mapper` is True the mapper is installed once in each
+        slave process when the pool is created. Otherwise, the mapper is
+        pickled and sent together with every item.
+        
+        When a combiner or a `BaseBatchMapper` is used, items are grouped
+        into batches of `batch_size` (defaults to `chunk_size` or 100) which 
+        are mapped (and combined) in the slaves. The mapper is always 
+        installed in this case.
+        
+        If `num_reducers` > 1, reduction is done by `num_reducers` 
+        processes (see `_go_partitioned`).
+        
+        If `input_splits` returns splits, each one is read and mapped in 
+        batches of `batch_size` by a slave of the process or thread backend
+        (see `_go_splits`). This cannot be used with checkpoints, stats, 
+        ordered results, in flight limits or a `worker_pool`. In other 
+        cases, like a single process, the master reads the splits in order.
+        
+        If `ordered` is True, results are reduced in generator order while
+        still being mapped in parallel. Results which arrive before earlier
+        ones wait in a buffer of about `reorder_buffer` items, no more
+        items are mapped while it is full (see `_ReorderBuffer`). Values 
+        combined in a batch are reduced in the order of the batches.
+        
+        `max_in_flight` and `max_in_flight_bytes` limit the items read
+        from the generator which were not mapped yet (see `_InFlightLimiter`).
+        Items are also grouped in batches when these are used.
+        
+        If `chunk_size` is 'auto', batches are used and their size is tuned
+        during the run (see `_ChunkSizeTuner`), unless `batch_size` is given.
+        
+        If `spill_after` is given, at most this number of mapped values are 
+        kept in memory, the rest is written in sorted runs to temporary
+        files in `spill_dir`. The reducer is then called in key order after
+        every item was mapped (see `_ExternalSorter`).
+        
+        If a `checkpoint` file is given, the state of the reduction (see
+        `checkpoint_state`) and the number of items reduced are saved every 
+        `checkpoint_every` items. Results are reduced in generator order in
+        this case, as with `ordered`. With `resume`, the state is restored 
+        (see `restore_state`) and the items already reduced are skipped.
+        
+        If `retries`, `quarantine` or `max_failures` are given, exceptions
+        raised by the mapper do not stop the run. Each failed item is mapped
+        again up to `retries` times. Items which still fail are saved to 
+        the `quarantine` file and are not reduced. The run fails only if
+        more than `max_failures` items fail (see `_SafeMapper` and
+        `_FailureFilter`).
+        
+        If `max_tasks_per_worker` is given, each slave process is replaced
+        after mapping that number of tasks. If `max_worker_memory` (MB) is
+        given, the resident memory of the slaves is checked while results 
+        arrive and, once one of them goes over it, all of them are replaced
+        (see `_RecyclingPool`), this needs /proc. The peak memory of each 
+        slave is reported at the end when /proc can be read.
+        
+        If `share_arrays_above` is given, numpy arrays of at least that many
+        bytes mapped (or combined) by slave processes are written to files
+        in `share_dir` (/dev/shm by default) instead of being pickled 
+        through the pipe. The reducer receives a copy-on-write memory map of
+        the file (see `_ArraySharer`). This is only done by the process 
+        backend with more than one process. Creating the files costs more 
+        than pickling small arrays, it pays off from about a megabyte (see
+        `bench_shared_arrays` in the benchmarks).
+        
+        If a `cache_dir` is given, the value mapped for each item is saved
+        there and reused by later runs with the same mapper (see 
+        `_CachingMapper`), so unchanged items are not mapped again. At the 
+        end of the run, the least recently used values are removed until
+        the cache takes at most `cache_max_bytes`.
+        
+        If `speculate` is given, tasks (items or batches) running for more
+        than `speculate` times the median task time are sent again to the
+        pool, the first result to arrive is reduced and the other ignored
+        (see `_SpeculativePool`). Items are sent in chunks of 100 unless a
+        `chunk_size` is given. Only the process and thread backends can
+        speculate, without partitioned reductions, input splits, shared 
+        pools or replaced processes.
+        
+        If `progress` is True, the number of items mapped, the throughput
+        and an ETA are printed every `progress_every` seconds by a thread
+        of the master (see `_Progress`). The ETA needs `total_items` (by 
+        default the result of `total_items`). With input splits, progress 
+        is measured in splits.
+        
+        If `stats` is True, counters and timers of each stage are reported
+        every `stats_every` seconds to stderr, or to `stats_file` if given
+        (see `_RunStats`). Items are mapped in batches in this case.
+        
+        If a `profile_prefix` is given, each slave (and reducer) process is 
+        profiled and saves its results to `<profile_prefix>.worker-<pid>.prof`
+        when it exits.
         '''
+        if checkpoint and (num_reducers > 1 or spill_after):
+            raise ValueError('Checkpoints cannot be used with partitioned '
+                             'or spilled reductions')
+        
+        if stats and num_reducers > 1:
+            raise ValueError('Stats cannot be used with partitioned '
+                             'reductions')
+        
+        if resume and not checkpoint:
+            raise ValueError('A checkpoint file is needed to resume')
+        
+        if ordered and num_reducers > 1:
+            raise ValueError('Ordered results cannot be used with '
+                             'partitioned reductions')
+        
+        tolerant = bool(retries or quarantine or max_failures is not None)
+        if backend == 'asyncio':
+            if asyncio is None:
+                raise ValueError('The asyncio backend requires Python 3')
+            
+            if num_reducers > 1 or checkpoint or stats or tolerant or \
+                    ordered or cache_dir:
+                raise ValueError('The asyncio backend cannot be used with '
+                                 'partitioned reductions, checkpoints, '
+                                 'stats, failure tolerance, ordered '
+                                 'results or caches')
+        elif backend == 'serial':
+            num_procs = 1
+        elif backend == 'remote':
+            if coordinator is None or num_reducers > 1:
+                raise ValueError('The remote backend needs a coordinator '
+                                 'address and cannot be used with '
+                                 'partitioned reductions')
+            num_procs = max(num_procs, 2)
+            
+            #each list of tasks is a round trip to a slave
+            if not chunk_size:
+                chunk_size = 100
+        elif backend == 'thread':
+            #threads of the same process would overwrite the profile
+            profile_prefix = None
+        
+        if worker_pool is not None:
+            if backend != 'process' or num_reducers > 1:
+                raise ValueError('Worker pools can only be used by the '
+                                 'process backend without partitioned '
+                                 'reductions')
+            num_procs = worker_pool.num_procs
+            profile_prefix = None
+        
+        monitor = None
+        if max_tasks_per_worker or max_worker_memory:
+            if backend != 'process' or worker_pool is not None or \
+                    num_reducers > 1:
+                raise ValueError('Processes can only be replaced by the '
+                                 'process backend without shared pools or '
+                                 'partitioned reductions')
+            
+            #peaks are only reported when they can be read
+            if max_worker_memory or _MemoryMonitor.available():
+                monitor = _MemoryMonitor(max_worker_memory)
+        
+        if speculate and (backend not in _POOLS or num_reducers > 1 or 
+                          worker_pool is not None or max_tasks_per_worker or
+                          max_worker_memory):
+            raise ValueError('Speculation can only be used by the process '
+                             'and thread backends, without partitioned '
+                             'reductions, shared pools or replaced '
+                             'processes')
+        
+        #each task is sent (and timed) on its own
+        if speculate and not chunk_size:
+            chunk_size = 100
+        
+        pool_class = _POOLS.get(backend, Pool)
+        
+        def new_pool(mapper, combiner = None, partitions = None):
+            '''Creates the pool, or installs the mapper in the shared one'''
+            if worker_pool is not None:
+                worker_pool.install(mapper, combiner)
+                return worker_pool
+            
+            if backend == 'remote':
+                return _Coordinator(coordinator, authkey, mapper, combiner)
+            
+            #the runner reads the input splits in the slaves, it is only
+            #sent with them since it may not be picklable
+            reader = self if splits is not None else None
+            initargs = (mapper, combiner, partitions, profile_prefix, reader)
+            if max_worker_memory:
+                return _RecyclingPool(
+                    lambda: Pool(num_procs, _install_mapper, initargs, 
+                                 max_tasks_per_worker), monitor, num_procs)
+            
+            if max_tasks_per_worker:
+                pool = Pool(num_procs, _install_mapper, initargs, 
+                            max_tasks_per_worker)
+                if monitor is not None:
+                    monitor.start(pool)
+                return pool
+            
+            pool = pool_class(num_procs, _install_mapper, initargs)
+            if speculate:
+                return _SpeculativePool(pool, num_procs, speculate)
+            return pool
+        
         pool = None
+        sorter = None
+        reorder = None
+        tracker = None
+        failures = None
+        shared_dir = None
+        checkpointer = None
+        if checkpoint:
+            checkpointer = _Checkpointer(checkpoint, checkpoint_every)
+        
+        run_stats = None
+        if stats:
+            run_stats = _RunStats(stats_every, stats_file)
+        
+        limiter = None
+        tuner = None
+        if chunk_size == 'auto':
+            chunk_size = None
+            if num_procs > 1 and not batch_size and backend != 'asyncio':
+                tuner = _ChunkSizeTuner()
+        
+        if num_procs > 1 and (max_in_flight or max_in_flight_bytes) and \
+                backend != 'asyncio':
+            limiter = _InFlightLimiter(max_in_flight, max_in_flight_bytes)
+        
         try:
             print('Initiating...', file=sys.stderr)
     
-            igen = self.item_generator()
-            reducer = self.reducer()
+            splits = None
+            if self._input is not None:
+                igen = iter(self._input)
+            else:
+                splits = self.input_splits()
+                if splits is None:
+                    igen = self.item_generator()
+                elif num_procs > 1 and backend in _POOLS and \
+                        worker_pool is None:
+                    if checkpointer is not None or run_stats is not None or \
+                            ordered or limiter is not None or speculate:
+                        raise ValueError('Input splits cannot be used with '
+                                         'checkpoints, stats, ordered '
+                                         'results, in flight limits or '
+                                         'speculation')
+                    igen = None
+                    tuner = None
+                else:
+                    igen = chain.from_iterable(self.read_split(split) 
+                                               for split in splits)
+                    splits = None
+            reducer = self.reducer() if num_reducers <= 1 else None
+            if reducer is not None and spill_after:
+                sorter = _ExternalSorter(spill_after, spill_dir)
+                sorted_reducer, reducer = reducer, sorter
+            
             mapper = self.mapper()
+            combiner = self.combiner()
+            if cache_dir:
+                mapper = _caching_mapper(mapper, cache_dir, combiner)
+            
+            if resume:
+                position, state = checkpointer.load()
+                if state is not None:
+                    print('Resuming after %d items' % position, 
+                          file=sys.stderr)
+                    reducer = self.restore_state(state)
+                    igen = islice(igen, position, None)
+            
+            if progress:
+                unit = 'items'
+                if splits is not None:
+                    unit = 'splits'
+                    total_items = len(splits)
+                else:
+                    if total_items is None:
+                        total_items = self.total_items()
+                    if total_items is not None and resume and \
+                            state is not None:
+                        total_items -= position
+                
+                tracker = _Progress(total_items, progress_every, unit)
+                tracker.start()
+            
+            #reducer whose state is saved by checkpoints
+            state_reducer = reducer
+            if tolerant:
+                mapper = _SafeMapper(mapper, retries)
+                failures = _FailureFilter(reducer, quarantine, max_failures)
+                if reducer is not None:
+                    reducer = failures
+            
+            if share_arrays_above is not None and num_procs > 1 and \
+                    backend == 'process':
+                if share_dir is None and os.path.isdir('/dev/shm'):
+                    share_dir = '/dev/shm'
+                shared_dir = tempfile.mkdtemp(prefix='shared-arrays-', 
+                                              dir=share_dir)
+                
+                #arrays are shared once they leave the slave
+                if combiner is not None:
+                    combiner = _ArraySharer(combiner, share_arrays_above, 
+                                            shared_dir)
+                else:
+                    mapper = _array_sharer(mapper, share_arrays_above, 
+                                           shared_dir)
+                
+                if reducer is not None:
+                    reducer = _ArrayLoader(reducer)
+            
+            #a single coroutine at a time with one process
+            if backend == 'asyncio':
+                if combiner is not None or \
+                        isinstance(mapper, BaseBatchMapper):
+                    raise ValueError('The asyncio backend only supports '
+                                     'per item mappers')
+                
+                print('Using %d coroutines' % max(num_procs, 1), 
+                      file=sys.stderr)
+                if tracker is not None:
+                    igen = tracker.count(igen)
+                _run_coroutines(igen, mapper, reducer, max(num_procs, 1))
+            
+            elif num_reducers > 1:
+                self._go_partitioned(igen, mapper, combiner, num_procs, 
+                                     num_reducers, 
+                                     batch_size or chunk_size or 100, 
+                                     limiter, spill_after, spill_dir,
+                                     profile_prefix, pool_class, failures,
+                                     splits, tracker, tuner)
+            
+            elif splits is not None:
+                print('Using %d %s workers' % (num_procs, backend), 
+                      file=sys.stderr)
+                results = Queue()
+                pool = new_pool(mapper, combiner, [results])
+                self._go_splits(splits, pool, results, reducer, 
+                                batch_size or chunk_size or 100, failures,
+                                tracker)
+            
+            elif combiner is not None or limiter is not None or \
+                    tuner is not None or checkpointer is not None or \
+                    run_stats is not None or \
+                    isinstance(mapper, BaseBatchMapper):
+                batch_size = batch_size or chunk_size or 100
+                if tuner is not None:
+                    print('Mapping batches of tuned size', file=sys.stderr)
+                    chunks = tuner.chunks(igen, 2 * num_procs)
+                else:
+                    print('Mapping batches of %d items' % batch_size, 
+                          file=sys.stderr)
+                    chunks = _chunk_generator(igen, batch_size)
+                
+                if checkpointer is not None:
+                    chunks = checkpointer.track(chunks)
+                
+                if run_stats is not None:
+                    chunks = run_stats.count_generated(chunks)
+                
+                if tracker is not None:
+                    chunks = tracker.track(chunks)
+                
+                if num_procs > 1:
+                    print('Using %d %s workers' % (num_procs, backend), 
+                          file=sys.stderr)
+                    if limiter is not None:
+                        chunks = limiter.throttle(chunks)
+                    
+                    pool = new_pool(mapper, combiner)
+                    
+                    if run_stats is not None:
+                        helper = _instrumented_chunk_processor_helper
+                    elif tuner is not None:
+                        helper = _timed_chunk_processor_helper
+                    else:
+                        helper = _chunk_processor_helper
+                    
+                    #checkpoints need results in the generator order
+                    if ordered or checkpointer is not None:
+                        reorder = _ReorderBuffer(
+                            max(reorder_buffer // batch_size, 2 * num_procs))
+                        results = reorder.imap(pool.imap_unordered, helper,
+                                               chunks)
+                    else:
+                        results = pool.imap_unordered(helper, chunks)
+                else:
+                    print('Using one mapper only', file = sys.stderr)
+                    if run_stats is not None:
+                        results = (_instrumented_map_chunk(mapper, combiner, 
+                                                           chunk)
+                                   for chunk in chunks)
+                    else:
+                        results = (_map_chunk(mapper, combiner, chunk) 
+                                   for chunk in chunks)
+                
+                if run_stats is not None:
+                    results = run_stats.track(results)
+                    if tuner is None:
+                        results = (mapped for _, _, mapped in results)
+                
+                if tuner is not None:
+                    results = tuner.track(results)
+                
+                if limiter is not None:
+                    results = limiter.release_each(results)
+                
+                if tracker is not None:
+                    results = tracker.tracked(results)
+                
+                for combined in results:
+                    if run_stats is not None:
+                        start = time.time()
+                    
+                    for key, value in combined:
+                        reducer(key, value)
+                    
+                    if run_stats is not None:
+                        run_stats.reduced(time.time() - start)
+                    
+                    if checkpointer is not None:
+                        checkpointer.chunk_done(self, state_reducer)
             
-            if (num_procs > 1):
-                print('Using %d processes' %num_procs, file=sys.stderr)
+            elif (num_procs > 1):
+                print('Using %d %s workers' % (num_procs, backend), 
+                      file=sys.stderr)
                 
-                def igen_helper():
-                    '''
-                    Helper generator to pass the mapper object
-                    to each slave process
-                    '''
-                    for key, item in igen:
-                        yield (mapper, key, item)
+                if install_mapper:
+                    #the mapper is sent once to each slave, only the
+                    #(key, item) tuples travel through the pipe
+                    pool = new_pool(mapper)
+                    tasks = igen
+                    helper = _processor_helper
+                else:
+                    def igen_helper():
+                        '''
+                        Helper generator to pass the mapper object
+                        to each slave process
+                        '''
+                        for key, item in igen:
+                            yield (mapper, key, item)
+                    
+                    pool = new_pool(None)
+                    tasks = igen_helper()
+                    helper = _item_processor_helper
                 
-                pool = Pool(num_procs)
                 results = None
-                if not chunk_size:
-                    results = pool.imap_unordered(_processor_helper, 
-                                                  igen_helper())
+                if ordered:
+                    #slaves take whole chunks, which must fit in the buffer
+                    reorder = _ReorderBuffer(
+                        max(reorder_buffer, 2 * num_procs * (chunk_size or 1)))
+                    results = reorder.imap(pool.imap_unordered, helper, 
+                                           tasks, chunk_size or 1)
+                elif not chunk_size:
+                    results = pool.imap_unordered(helper, tasks)
                 else:
-                    results = pool.imap_unordered(_processor_helper, 
-                                                  igen_helper(), chunk_size)
+                    results = pool.imap_unordered(helper, tasks, chunk_size)
+                
+                if tracker is not None:
+                    results = tracker.count(results)
                 
                 for key, value in results:
                     reducer(key, value)
     
             else:
                 print('Using one mapper only', file = sys.stderr)
-                    
+                
+                if tracker is not None:
+                    igen = tracker.count(igen)
                 for key, item in igen:
                     value = mapper(key, item)
                     reducer(key, value)
+            
+            if tracker is not None:
+                tracker.stop()
+            
+            if sorter is not None:
+                sorter.reduce(sorted_reducer)
                     
             self.finalize()
+            if checkpointer is not None:
+                checkpointer.remove()
+            if run_stats is not None:
+                run_stats.emit()
+            if failures is not None:
+                print('Failed items: %d' % failures.num_failures, 
+                      file=sys.stderr)
+            if monitor is not None:
+                monitor.stop()
+                monitor.report()
+            if limiter is not None:
+                print('Max in flight: %d items, %d bytes' % 
+                      (limiter.peak_items, limiter.peak_bytes), 
+                      file=sys.stderr)
+            if reorder is not None:
+                print('Max results waiting to be reordered: %d' % 
+                      reorder.peak, file=sys.stderr)
+            if isinstance(pool, _SpeculativePool):
+                print('Speculative copies: %d, %d finished first' % 
+                      (pool.copies, pool.copies_won), file=sys.stderr)
+            if cache_dir:
+                num_values, num_bytes = _evict_cache(cache_dir, 
+                                                     cache_max_bytes)
+                print('Cached values: %d, %d bytes' % 
+                      (num_values, num_bytes), file=sys.stderr)
             print('Done.', file = sys.stderr)
         finally:
-            if pool:
+            if tracker is not None:
+                tracker.stop(report = False)
+            
+            if limiter is not None:
+                limiter.close()
+            
+            if reorder is not None:
+                reorder.close()
+            
+            if tuner is not None:
+                tuner.close()
+            
+            if monitor is not None:
+                monitor.stop()
+            
+            if sorter is not None:
+                sorter.close()
+            
+            if failures is not None:
+                failures.close()
+            
+            if shared_dir is not None:
+                shutil.rmtree(shared_dir, ignore_errors=True)
+            
+            if pool is not None and pool is worker_pool:
+                pool.uninstall()
+            elif pool:
                 pool.close()
                 pool.join()
 
-def _processor_helper(tup):
-    '''Helper for the use of multiprocessing'''
-    mapper, key, item = tup
-    return key, mapper(key, item)
\ No newline at end of file
+    def _go_splits(self, splits, pool, results, reducer, batch_size, 
+                   failures = None, tracker = None):
+        '''
+        Maps the items of every input split in the slaves of `pool`, each 
+        one reads a split with `read_split`. Items are mapped in batches of
+        `batch_size` and the values are sent back through the `results` 
+        queue, the only partition installed in the slaves. The master 
+        reduces them with `reducer` as they arrive. Items which failed go
+        to `failures`. Splits mapped are counted by the `tracker`.
+        '''
+        tasks = [(split, batch_size) for split in splits]
+        failed_items = []
+        errors = []
+        
+        def _dispatch():
+            '''Maps the splits, then signals the end of the results'''
+            try:
+                mapped = pool.imap_unordered(_split_processor_helper, tasks)
+                if tracker is not None:
+                    mapped = tracker.count(mapped)
+                
+                for failed in mapped:
+                    failed_items.extend(failed)
+                
+                #workers flush the queue when they exit
+                pool.close()
+                pool.join()
+            except Exception as error:
+                errors.append(error)
+            finally:
+                results.put(None)
+        
+        dispatcher = threading.Thread(target=_dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+        try:
+            for batch in iter(results.get, None):
+                for key, value in batch:
+                    reducer(key, value)
+            
+            if errors:
+                raise errors[0]
+            
+            for key, failure in failed_items:
+                failures(key, failure)
+        except Exception:
+            #slaves would wait forever for the queue to be read
+            pool.terminate()
+            raise
+
+    def _go_partitioned(self, igen, mapper, combiner, num_procs, 
+                        num_reducers, batch_size, limiter = None, 
+                        spill_after = None, spill_dir = None, 
+                        profile_prefix = None, pool_class = Pool, 
+                        failures = None, splits = None, tracker = None,
+                        tuner = None):
+        '''
+        Shuffle stage. Starts `num_reducers` processes, each one with its
+        own reducer (created by `reducer`). Items are mapped in batches of
+        `batch_size` and the results are hash partitioned by key, every
+        partition is sent directly from the mapper to its reducer process.
+        The states of each partition (see `reducer_state`) are then given
+        to `merge_partitions`. If a `limiter` is given, the batches
+        are throttled by it. `spill_after`, `spill_dir` and 
+        `profile_prefix` are used by each process as in `_go`. Mapping is
+        done by a pool of `pool_class`. Items which failed are not sent to
+        the reducers but to `failures`, in the master. If `splits` are
+        given, the slaves read their items instead of `igen` (see 
+        `_go_splits`). Items (or splits) mapped are counted by the 
+        `tracker`. If a `tuner` is given, it picks the size of each batch 
+        instead of `batch_size` (see `_ChunkSizeTuner`).
+        '''
+        print('Using %d reducer processes' % num_reducers, file=sys.stderr)
+        
+        queues = [Queue() for _ in range(num_reducers)]
+        states = Queue()
+        reducers = [Process(target=_reduce_partition, 
+                            args=(self, partition, queues[partition], 
+                                  states, spill_after, spill_dir,
+                                  profile_prefix))
+                    for partition in range(num_reducers)]
+        
+        pool = None
+        done = False
+        try:
+            for proc in reducers:
+                proc.start()
+            
+            if num_procs > 1:
+                print('Using %d workers' % num_procs, file=sys.stderr)
+                if splits is not None:
+                    tasks = [(split, batch_size) for split in splits]
+                    helper = _split_processor_helper
+                elif tuner is not None:
+                    tasks = tuner.chunks(igen, 2 * num_procs)
+                    helper = _timed_partition_processor_helper
+                else:
+                    tasks = _chunk_generator(igen, batch_size)
+                    helper = _partition_processor_helper
+                
+                if limiter is not None:
+                    tasks = limiter.throttle(tasks)
+                
+                if tracker is not None and splits is None:
+                    tasks = tracker.track(tasks)
+                
+                reader = self if splits is not None else None
+                pool = pool_class(num_procs, _install_mapper, 
+                            (mapper, combiner, queues, profile_prefix, reader))
+                results = pool.imap_unordered(helper, tasks)
+                if tuner is not None:
+                    results = tuner.track(results)
+                
+                if limiter is not None:
+                    results = limiter.release_each(results)
+                
+                if tracker is not None:
+                    if splits is None:
+                        results = tracker.tracked(results)
+                    else:
+                        results = tracker.count(results)
+                
+                for failed in results:
+                    for key, failure in failed:
+                        failures(key, failure)
+                
+                #workers flush their queues when they exit, only then we 
+                #can signal the end of the partitions
+                pool.close()
+                pool.join()
+                pool = None
+            else:
+                print('Using one mapper only', file = sys.stderr)
+                for chunk in _chunk_generator(igen, batch_size):
+                    failed = _partition_chunk(mapper, combiner, queues, chunk)
+                    if tracker is not None:
+                        tracker.add(len(chunk))
+                    for key, failure in failed:
+                        failures(key, failure)
+            
+            for partition_queue in queues:
+                partition_queue.put(None)
+            
+            partition_states = [None] * num_reducers
+            for _ in range(num_reducers):
+                partition, state, error = states.get()
+                if error:
+                    raise RuntimeError('Reducer %d failed:\n%s' % 
+                                       (partition, error))
+                partition_states[partition] = pickle.loads(state)
+            
+            done = True
+            self.merge_partitions(partition_states)
+        finally:
+            if tuner is not None:
+                tuner.close()
+            
+            if pool:
+                pool.terminate()
+                pool.join()
+            
+            for proc in reducers:
+                if not done and proc.is_alive():
+                    proc.terminate()
+                proc.join()
+
+def _chunk_size(value):
+    '''Argument type for the chunk size, an integer or auto'''
+    if value == 'auto':
+        return value
+    return int(value)
+
+class _ChunkSizeTuner(object):
+    '''
+    Picks the number of items in each chunk based on the measured cost of 
+    the items. Chunks should take about `target_time` seconds to be mapped, 
+    so that the cost of sending them to the processes is amortized, while
+    being small enough to keep every process busy at the end of the run.
+    The pickled size of a chunk is also kept under `max_bytes`.
+    
+    The cost is measured by the slaves, with the time taken to map each
+    chunk (an exponential moving average with weight `alpha`). The first
+    chunks have `min_size` items so that they are measured quickly, and
+    the pickled size per item is measured with the first chunk sent and 
+    the first values received. Since `Pool` reads every task as soon as 
+    it can, chunks may be sent at most `max_pending` ahead of their 
+    results (see `chunks`), so later chunks get the tuned size.
+    '''
+    
+    def __init__(self, target_time = 0.05, max_bytes = 2 ** 20, 
+                 min_size = 1, max_size = 10000, alpha = 0.2):
+        self.target_time = target_time
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.max_size = max_size
+        self.alpha = alpha
+        
+        self.item_time = None
+        self.item_bytes = None
+        self.chunk_size = min_size
+        
+        self._in_bytes = None
+        self._gate = None
+    
+    def _pick(self):
+        '''Chunk size for the current cost per item'''
+        size = self.target_time / max(self.item_time, 1e-9)
+        if self.item_bytes:
+            size = min(size, self.max_bytes / self.item_bytes)
+        return int(min(max(size, self.min_size), self.max_size))
+    
+    def update(self, num_items, elapsed):
+        '''Updates the cost per item with a chunk mapped in `elapsed` s'''
+        if num_items == 0:
+            return
+        
+        item_time = elapsed / num_items
+        if self.item_time is None:
+            self.item_time = item_time
+        else:
+            self.item_time = self.alpha * item_time + \
+                    (1 - self.alpha) * self.item_time
+        
+        #avoids logging small changes
+        new_size = self._pick()
+        if abs(new_size - self.chunk_size) > 0.25 * self.chunk_size:
+            self.chunk_size = new_size
+            print('Chunk size: %d' % self.chunk_size, file=sys.stderr)
+    
+    def _chunks(self, igen):
+        '''Groups the (key, item) tuples in lists of the current size'''
+        chunk = []
+        for key_item in igen:
+            chunk.append(key_item)
+            if len(chunk) >= self.chunk_size:
+                if self._in_bytes is None:
+                    self._in_bytes = len(pickle.dumps(
+                        chunk, pickle.HIGHEST_PROTOCOL)) / len(chunk)
+                yield chunk
+                chunk = []
+        
+        if chunk:
+            yield chunk
+    
+    def chunks(self, igen, max_pending = None):
+        '''
+        Groups the (key, item) tuples in lists of the current size. If
+        `max_pending` is given, at most that number of chunks are yielded
+        before their results go through `track`.
+        '''
+        chunks = self._chunks(igen)
+        if max_pending is None:
+            return chunks
+        
+        self._gate = _Gate(chunks, max_pending)
+        return iter(self._gate)
+    
+    def track(self, results):
+        '''
+        Consumes the results of `_timed_chunk_processor_helper`, updating
+        the cost per item, and yields the mapped values.
+        '''
+        for num_items, elapsed, mapped in results:
+            if self._gate is not None:
+                self._gate.done()
+            
+            if self.item_bytes is None and num_items:
+                self.item_bytes = (self._in_bytes or 0) + len(pickle.dumps(
+                    mapped, pickle.HIGHEST_PROTOCOL)) / num_items
+            
+            self.update(num_items, elapsed)
+            yield mapped
+    
+    def close(self):
+        '''Stops yielding chunks, the pool would wait for them forever'''
+        if self._gate is not None:
+            self._gate.close()
+
+class _ExternalSorter(object):
+    '''
+    Collects (key, value) tuples keeping at most `max_items` of them in 
+    memory. When this number is reached, the tuples are sorted by key and 
+    spilled as a run to a temporary file in `tmp_dir`. `reduce` merges the
+    runs (a k-way merge) calling a reducer in key order. Keys must thus be
+    sortable, values are never compared.
+    '''
+    
+    def __init__(self, max_items, tmp_dir = None):
+        self.max_items = max_items
+        self.tmp_dir = tmp_dir
+        
+        self._buffer = []
+        self._runs = []
+    
+    def __call__(self, key, value):
+        self._buffer.append((key, value))
+        if len(self._buffer) >= self.max_items:
+            self.spill()
+    
+    def spill(self):
+        '''Writes the tuples in memory as a sorted run'''
+        if not self._buffer:
+            return
+        
+        self._buffer.sort(key=itemgetter(0))
+        run = tempfile.TemporaryFile(prefix='vod-spill-', dir=self.tmp_dir)
+        for key_value in self._buffer:
+            pickle.dump(key_value, run, pickle.HIGHEST_PROTOCOL)
+        
+        run.flush()
+        self._runs.append(run)
+        self._buffer = []
+    
+    def _read_run(self, run_idx):
+        '''
+        Reads back a run. Tuples are decorated with the run index and
+        position so that equal keys never compare the values.
+        '''
+        run = self._runs[run_idx]
+        run.seek(0)
+        position = 0
+        while True:
+            try:
+                key, value = pickle.load(run)
+            except EOFError:
+                return
+            
+            yield key, run_idx, position, value
+            position += 1
+    
+    def sorted_items(self):
+        '''Yields every (key, value) tuple in key order'''
+        if not self._runs:
+            self._buffer.sort(key=itemgetter(0))
+            for key_value in self._buffer:
+                yield key_value
+            return
+        
+        self.spill()
+        print('Merging %d spilled runs' % len(self._runs), file=sys.stderr)
+        runs = [self._read_run(i) for i in range(len(self._runs))]
+        for key, _, _, value in heapq.merge(*runs):
+            yield key, value
+    
+    def reduce(self, reducer):
+        '''Calls the reducer for every tuple in key order'''
+        for key, value in self.sorted_items():
+            reducer(key, value)
+    
+    def close(self):
+        '''Removes the spilled runs'''
+        for run in self._runs:
+            run.close()
+        
+        self._runs = []
+        self._buffer = []
+
+class _Checkpointer(object):
+    '''
+    Periodically saves the state of a reduction and the number of items
+    already reduced to `path`. Chunks must be given to `track` as they are
+    read from the generator and `chunk_done` must be called, in the same 
+    order, after the values of each chunk are reduced. A checkpoint is 
+    saved once at least `every` items were reduced since the last one.
+    '''
+    
+    def __init__(self, path, every):
+        self.path = path
+        self.every = every
+        
+        self.position = 0
+        self._last = 0
+        self._sizes = deque()
+    
+    def load(self):
+        '''Returns the position and state saved, or (0, None)'''
+        if not os.path.exists(self.path):
+            return 0, None
+        
+        with open(self.path, 'rb') as checkpoint_file:
+            position, state = pickle.load(checkpoint_file)
+        
+        self.position = self._last = position
+        return position, state
+    
+    def save(self, state):
+        '''Saves the state, the previous checkpoint is replaced atomically'''
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as checkpoint_file:
+            pickle.dump((self.position, state), checkpoint_file, 
+                        pickle.HIGHEST_PROTOCOL)
+        
+        os.rename(tmp_path, self.path)
+        self._last = self.position
+        print('Checkpoint after %d items' % self.position, file=sys.stderr)
+    
+    def track(self, chunks):
+        '''Yields the chunks, keeping their sizes'''
+        for chunk in chunks:
+            self._sizes.append(len(chunk))
+            yield chunk
+    
+    def chunk_done(self, runner, reducer):
+        '''Marks the oldest chunk as reduced, saving if needed'''
+        self.position += self._sizes.popleft()
+        if self.position - self._last >= self.every:
+            self.save(runner.checkpoint_state(reducer))
+    
+    def remove(self):
+        '''Removes the checkpoint file'''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def read_quarantine(path):
+    '''
+    Yields the (key, item, error) tuples saved to a quarantine file by 
+    `Runner`, where error is the traceback of the last failure.
+    '''
+    with open(path, 'rb') as quarantine_file:
+        while True:
+            try:
+                yield pickle.load(quarantine_file)
+            except EOFError:
+                return
+
+class _Failure(object):
+    '''Value mapped for an item which failed, see `_SafeMapper`'''
+    
+    def __init__(self, key, item, error):
+        self.key = key
+        self.item = item
+        self.error = error
+
+class _SafeMapper(BaseBatchMapper):
+    '''
+    Wraps a mapper, mapping each item again up to `retries` times if the
+    mapper raises an exception. A `_Failure` is returned for items which
+    still fail. When a batch mapper fails, the items of the batch are 
+    mapped one by one to find which ones fail.
+    '''
+    
+    def __init__(self, mapper, retries = 0):
+        self.mapper = mapper
+        self.retries = retries
+    
+    def _map_item(self, key, item):
+        '''Maps a single item, with retries'''
+        for _ in range(self.retries + 1):
+            try:
+                return self.mapper(key, item)
+            except Exception:
+                error = traceback.format_exc()
+        
+        return _Failure(key, item, error)
+    
+    def _map_batch(self, keys, items):
+        if isinstance(self.mapper, BaseBatchMapper):
+            try:
+                return self.mapper.map_batch(keys, items)
+            except Exception:
+                pass
+        
+        return [self._map_item(key, item) for key, item in zip(keys, items)]
+
+class _FailureFilter(object):
+    '''
+    Reducer wrapper which sets aside `_Failure` values, saving them to
+    the `quarantine` file. Other values go to the `reducer`. Raises an
+    exception once more than `max_failures` items failed.
+    '''
+    
+    def __init__(self, reducer, quarantine = None, max_failures = None):
+        self.reducer = reducer
+        self.max_failures = max_failures
+        self.num_failures = 0
+        
+        self._quarantine = None
+        if quarantine:
+            self._quarantine = open(quarantine, 'ab')
+    
+    def __call__(self, key, value):
+        if not isinstance(value, _Failure):
+            self.reducer(key, value)
+            return
+        
+        self.num_failures += 1
+        last_line = value.error.strip().split('\n')[-1]
+        print('Item with key %r failed: %s' % (key, last_line), 
+              file=sys.stderr)
+        
+        if self._quarantine is not None:
+            pickle.dump((value.key, value.item, value.error), 
+                        self._quarantine, pickle.HIGHEST_PROTOCOL)
+            self._quarantine.flush()
+        
+        if self.max_failures is not None and \
+                self.num_failures > self.max_failures:
+            raise RuntimeError('More than %d items failed, last one:\n%s' %
+                               (self.max_failures, value.error))
+    
+    def close(self):
+        '''Closes the quarantine file'''
+        if self._quarantine is not None:
+            self._quarantine.close()
+            self._quarantine = None
+
+class _SharedArray(object):
+    '''Placeholder of an array saved to a file by `_ArraySharer`'''
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def load(self):
+        '''
+        Memory maps the array (copy-on-write) and removes its file, the 
+        memory is released once the array is no longer used.
+        '''
+        array = np.load(self.path, mmap_mode='c')
+        os.remove(self.path)
+        return array
+
+class _ArraySharer(object):
+    '''
+    Wraps a mapper or combiner, saving the numpy arrays it returns of at 
+    least `min_bytes` to a file in `shared_dir`. A `_SharedArray` is 
+    returned for them, so only the path is pickled.
+    '''
+    
+    def __init__(self, func, min_bytes, shared_dir):
+        self.func = func
+        self.min_bytes = min_bytes
+        self.shared_dir = shared_dir
+    
+    def share(self, value):
+        '''Saves `value` if it is a large array, returns what to send'''
+        if not isinstance(value, np.ndarray) or value.dtype.hasobject or \
+                not value.size or value.nbytes < self.min_bytes:
+            return value
+        
+        fd, path = tempfile.mkstemp(suffix='.npy', dir=self.shared_dir)
+        with os.fdopen(fd, 'wb') as shared_file:
+            np.save(shared_file, value)
+        return _SharedArray(path)
+    
+    def __call__(self, key, item):
+        return self.share(self.func(key, item))
+
+class _BatchArraySharer(_ArraySharer, BaseBatchMapper):
+    '''Same as `_ArraySharer`, for batch mappers'''
+    
+    def _map_batch(self, keys, items):
+        return [self.share(value) 
+                for value in self.func.map_batch(keys, items)]
+
+def _array_sharer(mapper, min_bytes, shared_dir):
+    '''Wraps the mapper with the `_ArraySharer` of its kind'''
+    if isinstance(mapper, BaseBatchMapper):
+        return _BatchArraySharer(mapper, min_bytes, shared_dir)
+    return _ArraySharer(mapper, min_bytes, shared_dir)
+
+class _ArrayLoader(object):
+    '''Reducer wrapper which loads `_SharedArray` values'''
+    
+    def __init__(self, reducer):
+        self.reducer = reducer
+    
+    def __call__(self, key, value):
+        if isinstance(value, _SharedArray):
+            value = value.load()
+        self.reducer(key, value)
+
+#Value loaded for items which are not in the cache
+_MISSING = object()
+
+class _CachingMapper(object):
+    '''
+    Wraps a mapper, saving the value mapped for each item to a file in 
+    `cache_dir`. The file is named after a hash of the identity of the 
+    mapper (its class, `version` attribute and a digest of the pickled
+    mapper and `combiner`, so parameters count) and of the pickled key 
+    and item. Items found in the cache are not mapped again. Exceptions 
+    are not cached, and files are written atomically so that several 
+    processes can share the cache. Mappers which cannot be pickled (e.g.,
+    lambdas) cannot be told apart and are not cached.
+    '''
+    
+    def __init__(self, mapper, cache_dir, combiner = None):
+        self.mapper = mapper
+        self.cache_dir = cache_dir
+        
+        try:
+            #a fixed protocol keeps the names valid across python versions
+            pickled = pickle.dumps((mapper, combiner), 2)
+        except Exception as error:
+            raise ValueError('Only mappers which can be pickled can be '
+                             'cached: %s' % error)
+        
+        cls = mapper if inspect.isfunction(mapper) else type(mapper)
+        self.identity = '%s.%s:%r:%s' % (cls.__module__, cls.__name__, 
+                                         getattr(mapper, 'version', None),
+                                         hashlib.sha1(pickled).hexdigest())
+    
+    def _path(self, key, item):
+        '''File of the value of an item'''
+        digest = hashlib.sha1(self.identity.encode('utf8'))
+        #a fixed protocol keeps the names valid across python versions
+        digest.update(pickle.dumps((key, item), 2))
+        name = digest.hexdigest()
+        return os.path.join(self.cache_dir, name[:2], name[2:])
+    
+    def _load(self, path):
+        '''Loads a cached value, `_MISSING` if there is none'''
+        try:
+            with open(path, 'rb') as cache_file:
+                value = pickle.load(cache_file)
+        except Exception: #not cached, or not fully written
+            return _MISSING
+        
+        #recently used values are evicted last
+        os.utime(path, None)
+        return value
+    
+    def _save(self, path, value):
+        '''Saves a value, replacing the file atomically'''
+        dir_name = os.path.dirname(path)
+        if not os.path.isdir(dir_name):
+            try:
+                os.makedirs(dir_name)
+            except OSError: #created by another process
+                pass
+        
+        fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as cache_file:
+            pickle.dump(value, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    
+    def __call__(self, key, item):
+        path = self._path(key, item)
+        value = self._load(path)
+        if value is _MISSING:
+            value = self.mapper(key, item)
+            self._save(path, value)
+        return value
+
+class _BatchCachingMapper(_CachingMapper, BaseBatchMapper):
+    '''Same as `_CachingMapper`, items not cached are mapped in a batch'''
+    
+    def _map_batch(self, keys, items):
+        paths = [self._path(key, item) for key, item in zip(keys, items)]
+        values = [self._load(path) for path in paths]
+        missing = [i for i, value in enumerate(values) if value is _MISSING]
+        if missing:
+            mapped = self.mapper.map_batch([keys[i] for i in missing], 
+                                           [items[i] for i in missing])
+            for i, value in zip(missing, mapped):
+                self._save(paths[i], value)
+                values[i] = value
+        return values
+
+def _caching_mapper(mapper, cache_dir, combiner = None):
+    '''Wraps the mapper with the `_CachingMapper` of its kind'''
+    if isinstance(mapper, BaseBatchMapper):
+        return _BatchCachingMapper(mapper, cache_dir, combiner)
+    return _CachingMapper(mapper, cache_dir, combiner)
+
+def _evict_cache(cache_dir, max_bytes = None):
+    '''
+    Removes the least recently used files of the cache until it takes at
+    most `max_bytes`. Returns the number of files kept and their size.
+    '''
+    files = []
+    for dir_name, _, file_names in os.walk(cache_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_name, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError: #removed by another run
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    
+    total = sum(size for _, size, _ in files)
+    files.sort()
+    num_files = len(files)
+    for _, size, path in files:
+        if max_bytes is None or total <= max_bytes:
+            break
+        
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+        num_files -= 1
+    
+    return num_files, total
+
+class _MemoryMonitor(object):
+    '''
+    Reads the resident memory of the processes of a pool from /proc (so
+    this only works on Linux), keeping the peak of each one. `poll` tells 
+    if a process is using more than `max_mb`. Reads are done at most once
+    every `every` seconds. When nothing is done with the limit, `start` 
+    polls from a thread of the master instead.
+    '''
+    
+    def __init__(self, max_mb = None, every = 0.5):
+        if not self.available():
+            raise ValueError('Memory of processes is read from /proc')
+        
+        self.max_mb = max_mb
+        self.every = every
+        self.peaks = {}
+        self._last = 0
+        self._stopped = threading.Event()
+        self._poller = None
+    
+    @staticmethod
+    def available():
+        '''True if the memory of processes can be read'''
+        return os.path.exists('/proc/self/status')
+    
+    @staticmethod
+    def _read(pid):
+        '''Current and peak resident memory of a process, in MB'''
+        rss = peak = 0
+        try:
+            with open('/proc/%d/status' % pid) as status_file:
+                for line in status_file:
+                    if line.startswith('VmRSS:'):
+                        rss = int(line.split()[1]) / 1024
+                    elif line.startswith('VmHWM:'):
+                        peak = int(line.split()[1]) / 1024
+        except IOError: #process already finished
+            pass
+        return rss, peak
+    
+    def poll(self, pool, force = False):
+        '''Reads the processes of the pool, True if one is over the limit'''
+        now = time.time()
+        if not force and now - self._last < self.every:
+            return False
+        self._last = now
+        
+        over = False
+        #Pool does not expose its processes, which may be still starting
+        for proc in list(pool._pool):
+            if proc.pid is None:
+                continue
+            
+            rss, peak = self._read(proc.pid)
+            if peak:
+                self.peaks[proc.pid] = max(self.peaks.get(proc.pid, 0), peak)
+            if self.max_mb and rss > self.max_mb:
+                over = True
+        return over
+    
+    def start(self, pool):
+        '''Polls the processes of the pool until `stop` is called'''
+        def _poll():
+            '''Main loop of the thread'''
+            while not self._stopped.wait(self.every):
+                self.poll(pool, force = True)
+            self.poll(pool, force = True)
+        
+        self._poller = threading.Thread(target=_poll)
+        self._poller.daemon = True
+        self._poller.start()
+    
+    def stop(self):
+        '''Stops the thread started by `start`, after a last poll'''
+        self._stopped.set()
+        if self._poller is not None:
+            self._poller.join()
+            self._poller = None
+    
+    def report(self):
+        '''Prints the peak memory of each process'''
+        print('Peak memory of %d processes (MB):' % len(self.peaks), 
+              file=sys.stderr)
+        for pid in sorted(self.peaks):
+            print('   %d: %.1f' % (pid, self.peaks[pid]), file=sys.stderr)
+
+class _RecyclingPool(object):
+    '''
+    Same interface as `Pool` for `imap` and `imap_unordered`, but pools are
+    created by `make_pool`. When the `monitor` finds a process over its 
+    memory limit, no more tasks are sent to the current pool. Once its 
+    results arrive it is closed, and a new pool maps the remaining tasks.
+    
+    Since `Pool` reads every task as soon as it can, at most two chunks of
+    tasks per process (`num_procs`) are sent ahead of the results, 
+    otherwise the current pool would always get every task.
+    '''
+    
+    def __init__(self, make_pool, monitor, num_procs):
+        self.make_pool = make_pool
+        self.monitor = monitor
+        self.num_procs = num_procs
+        self.pool = None
+    
+    def _imap(self, ordered, helper, tasks, chunk_size):
+        '''Maps the tasks, replacing the pool when needed'''
+        tasks = iter(tasks)
+        while True:
+            self.pool = self.make_pool()
+            gate = _Gate(tasks, 2 * self.num_procs * chunk_size)
+            imap = self.pool.imap if ordered else self.pool.imap_unordered
+            try:
+                for result in imap(helper, gate, chunk_size):
+                    gate.done()
+                    if self.monitor.poll(self.pool):
+                        gate.close()
+                    yield result
+            finally:
+                gate.close()
+            
+            self.monitor.poll(self.pool, force = True)
+            if gate.exhausted:
+                return
+            
+            print('Replacing processes over %.1f MB' % self.monitor.max_mb, 
+                  file=sys.stderr)
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+    
+    def imap(self, helper, tasks, chunk_size = 1):
+        '''Same as `Pool.imap`'''
+        return self._imap(True, helper, tasks, chunk_size)
+    
+    def imap_unordered(self, helper, tasks, chunk_size = 1):
+        '''Same as `Pool.imap_unordered`'''
+        return self._imap(False, helper, tasks, chunk_size)
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+    
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+    
+    def join(self):
+        if self.pool is not None:
+            self.pool.join()
+
+class _SpeculativePool(object):
+    '''
+    Wraps a `pool` of `num_procs` processes (or threads) to mitigate 
+    stragglers. `imap_unordered` sends tasks one at a time, keeping 
+    `num_procs` of them running, and measures how long each one takes. 
+    Once `min_done` tasks finished, a task running for more than `factor`
+    times the median of the last `window` durations is sent again. The 
+    first result of a task is yielded, the other one is ignored, so each 
+    task is reduced once. 
+    
+    Copies which are still running when the pool is closed are stopped
+    by terminating it. Threads cannot be stopped, they are left running 
+    (as daemons) instead of being joined.
+    
+    Copies whose result (or exception) cannot be sent back fail the run.
+    Python 2 pools have no error callbacks, their results are checked
+    while waiting instead.
+    '''
+    
+    def __init__(self, pool, num_procs, factor, min_done = 3, poll = 0.05,
+                 window = 1000):
+        self.pool = pool
+        self.num_procs = num_procs
+        self.factor = factor
+        self.min_done = min_done
+        self.poll = poll
+        self.window = window
+        
+        self.copies = 0
+        self.copies_won = 0
+        
+        #durations in arrival order, and sorted for the median
+        self._recent = deque()
+        self._durations = []
+        self._outstanding = 0
+        self._abandoned = False
+        self._results = queue.Queue()
+        self._async = {}
+    
+    def _submit(self, helper, task_id, copy, task):
+        '''Sends a copy of a task, its result goes to the queue'''
+        tag = (task_id, copy)
+        self._outstanding += 1
+        
+        def _failed(error):
+            '''The copy failed outside of `_numbered_helper`'''
+            self._results.put((tag, None, error))
+        
+        args = ((helper, tag, task),)
+        if sys.version_info[0] >= 3:
+            self.pool.apply_async(_numbered_helper, args, 
+                                  callback=self._results.put,
+                                  error_callback=_failed)
+        else:
+            self._async[tag] = self.pool.apply_async(
+                _numbered_helper, args, callback=self._results.put)
+    
+    def _check_failed(self):
+        '''Sends the errors of failed copies to the queue (Python 2)'''
+        for tag, result in list(self._async.items()):
+            if result.ready() and not result.successful():
+                del self._async[tag]
+                try:
+                    result.get()
+                except Exception as error:
+                    self._results.put((tag, None, error))
+    
+    def _add_duration(self, duration):
+        '''Keeps the duration of a task, forgetting the oldest one'''
+        if len(self._recent) >= self.window:
+            oldest = self._recent.popleft()
+            del self._durations[bisect.bisect_left(self._durations, oldest)]
+        
+        self._recent.append(duration)
+        bisect.insort(self._durations, duration)
+    
+    def _speculate(self, helper, running):
+        '''Sends a copy of the tasks running for too long'''
+        if len(self._durations) < self.min_done:
+            return
+        
+        limit = self.factor * self._durations[len(self._durations) // 2]
+        now = time.time()
+        for task_id, entry in running.items():
+            task, start, copies = entry
+            if copies == 1 and now - start > limit:
+                self._submit(helper, task_id, 1, task)
+                entry[2] = 2
+                self.copies += 1
+    
+    def imap_unordered(self, helper, tasks, chunk_size = 1):
+        '''Same as `Pool.imap_unordered`, with speculative copies'''
+        if chunk_size > 1:
+            item_helper = helper
+            tasks = ((item_helper, chunk) 
+                     for chunk in _chunk_generator(tasks, chunk_size))
+            helper = _map_tasks
+        tasks = iter(tasks)
+        
+        running = {}
+        exhausted = False
+        next_id = 0
+        while True:
+            while not exhausted and len(running) < self.num_procs:
+                try:
+                    task = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                
+                self._submit(helper, next_id, 0, task)
+                running[next_id] = [task, time.time(), 1]
+                next_id += 1
+            
+            if not running:
+                return
+            
+            try:
+                (task_id, copy), result, error = \
+                        self._results.get(timeout=self.poll)
+            except queue.Empty:
+                self._check_failed()
+                self._speculate(helper, running)
+                continue
+            
+            self._async.pop((task_id, copy), None)
+            self._outstanding -= 1
+            if task_id not in running: #the other copy finished first
+                continue
+            
+            _, start, copies = running.pop(task_id)
+            if error is not None:
+                raise error
+            
+            if copies == 1:
+                self._add_duration(time.time() - start)
+            elif copy == 1:
+                self.copies_won += 1
+            self._speculate(helper, running)
+            
+            if helper is _map_tasks:
+                for item_result in result:
+                    yield item_result
+            else:
+                yield result
+    
+    def close(self):
+        if not self._outstanding:
+            self.pool.close()
+        elif isinstance(self.pool, ThreadPool):
+            self.pool.close()
+            self._abandoned = True
+        else:
+            self.pool.terminate()
+    
+    def terminate(self):
+        if isinstance(self.pool, ThreadPool):
+            self.close()
+        else:
+            self.pool.terminate()
+    
+    def join(self):
+        if not self._abandoned:
+            self.pool.join()
+
+class _Gate(object):
+    '''
+    Iterates over `tasks` until they are exhausted or it is closed, with 
+    at most `max_pending` tasks yielded but not marked as `done`.
+    '''
+    
+    def __init__(self, tasks, max_pending):
+        self.tasks = tasks
+        self.max_pending = max_pending
+        self.closed = False
+        self.exhausted = False
+        
+        self._pending = 0
+        self._cond = threading.Condition()
+    
+    def done(self):
+        '''Marks a task as done'''
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify()
+    
+    def close(self):
+        '''Stops yielding tasks'''
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+    
+    def __iter__(self):
+        while True:
+            with self._cond:
+                while not self.closed and self._pending >= self.max_pending:
+                    self._cond.wait()
+                
+                if self.closed:
+                    return
+                self._pending += 1
+            
+            try:
+                task = next(self.tasks)
+            except StopIteration:
+                self.exhausted = True
+                return
+            yield task
+
+class _RunStats(object):
+    '''
+    Counters and timers for each stage of a run. The slaves report, for
+    every chunk, the items mapped, a histogram of the time taken to map 
+    each item (power of two buckets in microseconds) and the pickled 
+    size of the chunk and of its results (see `_instrumented_map_chunk`).
+    The master counts the items generated, the time waiting for results
+    and the time spent reducing.
+    
+    Counters are emitted every `every` seconds and at the end of the run, 
+    as a JSON line appended to `out_path` or printed to stderr.
+    '''
+    
+    def __init__(self, every = 10, out_path = None):
+        self.every = every
+        self.out_path = out_path
+        
+        self.items_generated = 0
+        self.items_mapped = 0
+        self.items_per_worker = {}
+        self.map_latency_us = {}
+        self.map_time = 0.0
+        self.queue_wait = 0.0
+        self.reduce_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        
+        self._start = time.time()
+        self._last_emit = self._start
+    
+    def count_generated(self, chunks):
+        '''Yields the chunks, counting their items'''
+        for chunk in chunks:
+            self.items_generated += len(chunk)
+            yield chunk
+    
+    def track(self, results):
+        '''
+        Consumes the results of `_instrumented_map_chunk`, measuring the 
+        time waiting for them. Yields (number of items, map time, mapped).
+        '''
+        results = iter(results)
+        while True:
+            start = time.time()
+            try:
+                num_items, elapsed, mapped, worker = next(results)
+            except StopIteration:
+                return
+            self.queue_wait += time.time() - start
+            
+            self.items_mapped += num_items
+            self.map_time += elapsed
+            self.bytes_in += worker['bytes_in']
+            self.bytes_out += worker['bytes_out']
+            
+            pid = worker['pid']
+            self.items_per_worker[pid] = \
+                    self.items_per_worker.get(pid, 0) + num_items
+            for bucket, count in worker['latency'].items():
+                self.map_latency_us[bucket] = \
+                        self.map_latency_us.get(bucket, 0) + count
+            
+            yield num_items, elapsed, mapped
+    
+    def reduced(self, elapsed):
+        '''Adds the time of a reduce step, emits if it is time to'''
+        self.reduce_time += elapsed
+        if time.time() - self._last_emit >= self.every:
+            self.emit()
+    
+    def snapshot(self):
+        '''Dict with the current counters'''
+        elapsed = time.time() - self._start
+        latency = dict(('<%dus' % 2 ** (bucket + 1), count) 
+                       for bucket, count in self.map_latency_us.items())
+        workers = dict((str(pid), count) 
+                       for pid, count in self.items_per_worker.items())
+        
+        return {'elapsed': elapsed,
+                'items_generated': self.items_generated,
+                'items_mapped': self.items_mapped,
+                'items_per_second': self.items_mapped / max(elapsed, 1e-9),
+                'items_per_worker': workers,
+                'map_latency': latency,
+                'map_time': self.map_time,
+                'queue_wait': self.queue_wait,
+                'reduce_time': self.reduce_time,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out}
+    
+    def emit(self):
+        '''Writes the current counters'''
+        line = json.dumps(self.snapshot(), sort_keys=True)
+        if self.out_path:
+            with open(self.out_path, 'a') as stats_file:
+                print(line, file=stats_file)
+        else:
+            print('Stats:', line, file=sys.stderr)
+        
+        self._last_emit = time.time()
+
+class _Progress(object):
+    '''
+    Reports the progress of a run every `every` seconds from a thread, so 
+    the master only increments a counter. Each report has the number of
+    `unit` done, the throughput of the whole run and its moving average 
+    over the last `window` reports. With the `total` number of units the 
+    percentage done and an ETA, based on the moving average, are added.
+    '''
+    
+    def __init__(self, total = None, every = 10, unit = 'items', 
+                 window = 6):
+        self.total = total
+        self.every = every
+        self.unit = unit
+        self.done = 0
+        
+        self._sizes = deque()
+        self._start = time.time()
+        self._samples = deque([(self._start, 0)], maxlen=window + 1)
+        self._stopped = threading.Event()
+        self._reporter = None
+    
+    def track(self, tasks):
+        '''Yields the tasks (lists of items), keeping their sizes'''
+        for task in tasks:
+            self._sizes.append(len(task))
+            yield task
+    
+    def tracked(self, results):
+        '''
+        Yields the results of tracked tasks, the oldest one is counted for
+        each (results may arrive in another order).
+        '''
+        for result in results:
+            self.done += self._sizes.popleft()
+            yield result
+    
+    def count(self, results):
+        '''Yields the results, counting one unit for each'''
+        for result in results:
+            self.done += 1
+            yield result
+    
+    def add(self, count):
+        '''Counts `count` units as done'''
+        self.done += count
+    
+    def line(self):
+        '''The progress report'''
+        now = time.time()
+        done = self.done
+        self._samples.append((now, done))
+        
+        rate = done / max(now - self._start, 1e-9)
+        first_time, first_done = self._samples[0]
+        moving = (done - first_done) / max(now - first_time, 1e-9)
+        
+        line = 'Progress: %d %s' % (done, self.unit)
+        if self.total:
+            line += ' of %d (%.1f%%)' % (self.total, 100 * done / self.total)
+        line += ', %.1f %s/s (recent %.1f/s)' % (rate, self.unit, moving)
+        
+        if self.total and moving > 0:
+            left = max(self.total - done, 0) / moving
+            line += ', ETA %s' % _format_seconds(left)
+        return line
+    
+    def _report(self):
+        '''Main loop of the reporting thread'''
+        while not self._stopped.wait(self.every):
+            print(self.line(), file=sys.stderr)
+    
+    def start(self):
+        '''Starts reporting'''
+        self._reporter = threading.Thread(target=self._report)
+        self._reporter.daemon = True
+        self._reporter.start()
+    
+    def stop(self, report = True):
+        '''Stops reporting, printing a last report if `report` is True'''
+        if self._stopped.is_set():
+            return
+        
+        self._stopped.set()
+        if self._reporter is not None:
+            self._reporter.join()
+        if report:
+            print(self.line(), file=sys.stderr)
+
+def _format_seconds(seconds):
+    '''Formats seconds as h:mm:ss'''
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+def estimate_lines(paths, sample_lines = 10000):
+    '''
+    Estimates the number of lines of the files in `paths` from their total
+    size and the size taken by the first `sample_lines` lines of the first
+    file. Gzipped files (ending in .gz) are read to count the lines of 
+    the sample, the estimate then uses compressed sizes.
+    '''
+    paths = list(paths)
+    if not paths:
+        return 0
+    
+    total_size = sum(os.path.getsize(path) for path in paths)
+    with open(paths[0], 'rb') as raw_file:
+        lines_file = raw_file
+        if paths[0].endswith('.gz'):
+            lines_file = gzip.GzipFile(fileobj=raw_file)
+        
+        num_lines = 0
+        while num_lines < sample_lines and lines_file.readline():
+            num_lines += 1
+        
+        #compressed files are read ahead, this is approximate
+        sample_size = min(raw_file.tell(), os.path.getsize(paths[0]))
+    
+    if not sample_size:
+        return 0
+    return int(round(total_size * num_lines / sample_size))
+
+class _TimedMapper(object):
+    '''Wraps a mapper building a histogram of the time taken by each call'''
+    
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self.latency = {}
+    
+    def add(self, elapsed, count = 1):
+        '''Adds `count` calls which took `elapsed` seconds each'''
+        micros = elapsed * 1e6
+        bucket = int(math.log(micros, 2)) if micros >= 1 else 0
+        self.latency[bucket] = self.latency.get(bucket, 0) + count
+    
+    def __call__(self, key, item):
+        start = time.time()
+        value = self.mapper(key, item)
+        self.add(time.time() - start)
+        return value
+
+class _InFlightLimiter(object):
+    '''
+    Limits the number of items (and their pickled size in bytes) read from 
+    a generator but still not processed. Tasks are yielded by `throttle`, 
+    which blocks when a limit is reached until `release` is called. A 
+    task is always let through if nothing is in flight, so a task larger 
+    than the limit does not block forever.
+    
+    Since results of `imap_unordered` do not identify the task, tasks are 
+    released in the order they were yielded. The in flight sizes are thus 
+    approximate while the total is exact.
+    '''
+    
+    def __init__(self, max_items = None, max_bytes = None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        
+        self.items = 0
+        self.bytes = 0
+        self.peak_items = 0
+        self.peak_bytes = 0
+        
+        self._sizes = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+    
+    def _full(self, num_items, num_bytes):
+        '''Checks if adding the task would go over the limits'''
+        if self.items == 0:
+            return False
+        
+        if self.max_items and self.items + num_items > self.max_items:
+            return True
+        
+        if self.max_bytes and self.bytes + num_bytes > self.max_bytes:
+            return True
+        
+        return False
+    
+    def throttle(self, tasks):
+        '''Yields lists of items from `tasks` respecting the limits'''
+        for task in tasks:
+            num_items = len(task)
+            num_bytes = 0
+            if self.max_bytes:
+                num_bytes = len(pickle.dumps(task, pickle.HIGHEST_PROTOCOL))
+            
+            with self._cond:
+                while not self._closed and self._full(num_items, num_bytes):
+                    self._cond.wait()
+                
+                if self._closed:
+                    return
+                
+                self.items += num_items
+                self.bytes += num_bytes
+                self._sizes.append((num_items, num_bytes))
+                self.peak_items = max(self.peak_items, self.items)
+                self.peak_bytes = max(self.peak_bytes, self.bytes)
+            
+            yield task
+    
+    def release(self):
+        '''Marks the oldest task in flight as done'''
+        with self._cond:
+            num_items, num_bytes = self._sizes.popleft()
+            self.items -= num_items
+            self.bytes -= num_bytes
+            self._cond.notify()
+    
+    def release_each(self, results):
+        '''Yields every result, releasing one task for each'''
+        for result in results:
+            self.release()
+            yield result
+    
+    def close(self):
+        '''Stops throttling, pending calls to `throttle` will return'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class _ReorderBuffer(object):
+    '''
+    Maps tasks with `imap_unordered` but yields the results in the order
+    of the tasks. Results which arrive before earlier ones are kept in a 
+    heap. A task is only sent when it is less than `size` positions after
+    the next result to yield, so at most `size` results wait in the heap.
+    '''
+    
+    def __init__(self, size):
+        self.size = size
+        self.peak = 0
+        
+        self._next = 0
+        self._heap = []
+        self._closed = False
+        self._cond = threading.Condition()
+    
+    def _number(self, tasks, helper):
+        '''Yields the (helper, position, task) tuples for `_numbered_helper`'''
+        for position, task in enumerate(tasks):
+            with self._cond:
+                while not self._closed and \
+                        position >= self._next + self.size:
+                    self._cond.wait()
+                
+                if self._closed:
+                    return
+            
+            yield helper, position, task
+    
+    def _order(self, results):
+        '''
+        Yields the results of `_numbered_helper` in order, exceptions are 
+        raised when the result of their task is due.
+        '''
+        for position, result, error in results:
+            heapq.heappush(self._heap, (position, result, error))
+            self.peak = max(self.peak, len(self._heap))
+            
+            while self._heap and self._heap[0][0] == self._next:
+                _, result, error = heapq.heappop(self._heap)
+                if error is not None:
+                    raise error
+                
+                with self._cond:
+                    self._next += 1
+                    self._cond.notify()
+                yield result
+    
+    def imap(self, imap_unordered, helper, tasks, chunk_size = 1):
+        '''
+        Maps the tasks with `helper` using the `imap_unordered` function 
+        of a pool, yielding the results in order.
+        '''
+        numbered = self._number(tasks, helper)
+        return self._order(imap_unordered(_numbered_helper, numbered, 
+                                          chunk_size))
+    
+    def close(self):
+        '''Stops sending tasks, pending calls to `_number` will return'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class Pipeline(object):
+    '''
+    Chains runners (the stages), the (key, item) tuples emitted by a stage
+    (see `Runner.emit`) are the items of the next one, whose 
+    `item_generator` is not called. Nothing is written to disk.
+    
+    If `overlap` is False, each stage runs after the previous one and the
+    tuples emitted are kept in memory until mapped. Otherwise, every stage
+    runs at the same time in a thread of the master. Tuples are then
+    passed through queues of at most `buffer_size`, so a stage maps while
+    the previous one still reduces.
+    
+    pipeline = Pipeline([sessions, videos, fitting])
+    pipeline([['4'], ['4'], ['1']])
+    '''
+    
+    def __init__(self, stages, overlap = False, buffer_size = 10000):
+        self.stages = stages
+        self.overlap = overlap
+        self.buffer_size = buffer_size
+    
+    def __call__(self, args_list = None, pool = None):
+        '''
+        Runs every stage with its own command line arguments (in 
+        `args_list`). A `WorkerPool` may be given if stages do not overlap.
+        Returns True if every stage was successful.
+        '''
+        if not args_list:
+            args_list = [[] for _ in self.stages]
+        
+        if len(args_list) != len(self.stages):
+            raise ValueError('One list of arguments is needed per stage')
+        
+        if self.overlap and pool is not None:
+            raise ValueError('Overlapping stages cannot share a pool')
+        
+        try:
+            if self.overlap:
+                return self._run_overlapped(args_list)
+            else:
+                return self._run_sequential(args_list, pool)
+        finally:
+            for stage in self.stages:
+                stage._input = None
+                stage._sink = None
+    
+    def _run_sequential(self, args_list, pool):
+        '''Runs one stage after the other'''
+        items = None
+        last = len(self.stages) - 1
+        for i, (stage, args) in enumerate(zip(self.stages, args_list)):
+            emitted = deque()
+            if items is not None:
+                stage._input = _drain(items)
+            if i < last:
+                stage._sink = lambda key, item: emitted.append((key, item))
+            
+            if not stage(args, pool):
+                return False
+            items = emitted
+        
+        return True
+    
+    def _run_overlapped(self, args_list):
+        '''Runs all stages at once, each one in a thread'''
+        num_stages = len(self.stages)
+        sinks = [_StageSink(self.buffer_size) 
+                 for _ in range(num_stages - 1)]
+        results = [False] * num_stages
+        
+        def run(i):
+            '''Runs a stage, then signals the stages around it'''
+            try:
+                results[i] = self.stages[i](args_list[i])
+            finally:
+                if i < num_stages - 1:
+                    sinks[i].finish(results[i])
+                if i > 0 and not results[i]:
+                    sinks[i - 1].close()
+        
+        threads = []
+        for i, stage in enumerate(self.stages):
+            if i > 0:
+                stage._input = sinks[i - 1]
+            if i < num_stages - 1:
+                stage._sink = sinks[i].put
+            
+            thread = threading.Thread(target=run, args=(i,))
+            thread.daemon = True
+            threads.append(thread)
+        
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        return all(results)
+
+def _drain(items):
+    '''Yields and removes the tuples of a deque, freeing them as it goes'''
+    while items:
+        yield items.popleft()
+
+class _StageSink(object):
+    '''
+    Bounded queue between two overlapping stages of a `Pipeline`. The 
+    previous stage puts tuples and calls `finish`, the next one iterates 
+    over the tuples. If the next stage fails, it calls `close` and tuples 
+    put from then on are dropped, so the previous stage is not blocked.
+    '''
+    
+    _END = object()
+    
+    def __init__(self, max_size):
+        self._queue = queue.Queue(max_size)
+        self._closed = False
+        self._failed = False
+    
+    def put(self, key, item):
+        '''Adds a tuple, waiting if the queue is full'''
+        while not self._closed:
+            try:
+                self._queue.put((key, item), timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def finish(self, successful):
+        '''Marks the end of the tuples'''
+        self._failed = not successful
+        while not self._closed:
+            try:
+                self._queue.put(self._END, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def close(self):
+        '''Drops the queued tuples and every tuple put from now on'''
+        self._closed = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+    
+    def __iter__(self):
+        while True:
+            key_item = self._queue.get()
+            if key_item is self._END:
+                if self._failed:
+                    raise RuntimeError('The previous stage failed')
+                return
+            yield key_item
+
+class WorkerPool(object):
+    '''
+    A pool of processes which can be shared by several runners, so that
+    processes are started (and modules imported in them) only once. 
+    The modules named in `imports` are imported when each process starts.
+    
+    with WorkerPool(4, ['numpy', 'scipy.stats']) as pool:
+        first_runner(['4'], pool)
+        second_runner(['4'], pool)
+    
+    Before each run, the mapper (and combiner) is pickled to a temporary
+    file which each process loads once, when it receives the first task
+    of the run. Only one runner may use the pool at a time.
+    
+    Since `Pool` reads every task as soon as it can, at most two chunks 
+    of tasks per process are sent ahead of the results. When the mapper 
+    is uninstalled (e.g., the run failed) no more tasks of the run are 
+    sent, so they do not delay the next one.
+    '''
+    
+    def __init__(self, num_procs, imports = None):
+        self.num_procs = num_procs
+        self._pool = Pool(num_procs, _warm_worker, (list(imports or []),))
+        self._installed = None
+        self._runs = 0
+        self._gates = []
+    
+    def install(self, mapper, combiner = None):
+        '''Sets the mapper and combiner used by the following tasks'''
+        self.uninstall()
+        
+        fd, path = tempfile.mkstemp(prefix='vod-mapper-', suffix='.pkl')
+        with os.fdopen(fd, 'wb') as mapper_file:
+            pickle.dump((mapper, combiner), mapper_file, 
+                        pickle.HIGHEST_PROTOCOL)
+        
+        #temporary file names may be reused, runs are also numbered
+        self._runs += 1
+        self._installed = (self._runs, path)
+    
+    def uninstall(self):
+        '''Removes the current mapper, its tasks are no longer sent'''
+        for gate in self._gates:
+            gate.close()
+        self._gates = []
+        
+        if self._installed is not None:
+            os.remove(self._installed[1])
+            self._installed = None
+    
+    def _imap(self, imap, helper, tasks, chunk_size):
+        '''
+        Adds the mapper file and the helper to each task, which are sent
+        through a gate closed by `uninstall`.
+        '''
+        installed = self._installed
+        gate = _Gate(((installed, helper, task) for task in tasks), 
+                     2 * self.num_procs * chunk_size)
+        self._gates.append(gate)
+        
+        for result in imap(_shared_helper, iter(gate), chunk_size):
+            gate.done()
+            yield result
+    
+    def imap(self, helper, tasks, chunk_size = 1):
+        '''Same as `Pool.imap` using the installed mapper'''
+        return self._imap(self._pool.imap, helper, tasks, chunk_size)
+    
+    def imap_unordered(self, helper, tasks, chunk_size = 1):
+        '''Same as `Pool.imap_unordered` using the installed mapper'''
+        return self._imap(self._pool.imap_unordered, helper, tasks, 
+                          chunk_size)
+    
+    def close(self):
+        '''Stops the processes'''
+        self.uninstall()
+        self._pool.close()
+        self._pool.join()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+def run_worker(coordinator, authkey, num_procs = 1, timeout = 60):
+    '''
+    Maps the tasks of a `Runner` started with the remote backend, whose
+    coordinator listens at `coordinator` (a (host, port) tuple or a 
+    'host:port' string). `num_procs` slave processes are started, each
+    one connects with the `authkey` shared with the coordinator. Slaves 
+    try to connect for `timeout` seconds and return once the run is over.
+    The mapper is pickled by the coordinator, so its code must be 
+    installed in this machine too. From the command line:
+    
+        python -m vod.mapreducescript host:port --authkey key --num_procs 4
+    '''
+    if not isinstance(coordinator, tuple):
+        coordinator = _address(coordinator)
+    authkey = _authkey(authkey)
+    
+    if num_procs <= 1:
+        _remote_slave(coordinator, authkey, timeout)
+        return
+    
+    slaves = [Process(target=_remote_slave, 
+                      args=(coordinator, authkey, timeout))
+              for _ in range(num_procs)]
+    for slave in slaves:
+        slave.start()
+    for slave in slaves:
+        slave.join()
+
+def _address(value):
+    '''Argument type for addresses, a host:port string'''
+    host, port = value.rsplit(':', 1)
+    return host, int(port)
+
+def _authkey(value):
+    '''Authentication keys must be bytes'''
+    if value is None:
+        raise ValueError('An authentication key is needed to connect '
+                         'remote slaves')
+    if not isinstance(value, bytes):
+        value = value.encode('utf8')
+    return value
+
+class _Coordinator(object):
+    '''
+    Pool used by the remote backend. Listens at `address` for remote 
+    slaves (see `run_worker`), and sends each one the mapper and combiner
+    to install. Slaves then pull lists of tasks (of the `chunk_size` given
+    to `imap_unordered`) one at a time and send back their results. The 
+    tasks of a slave which disconnects are sent again to the others. 
+    '''
+    
+    def __init__(self, address, authkey, mapper, combiner = None):
+        if not isinstance(address, tuple):
+            address = _address(address)
+        
+        self.authkey = _authkey(authkey)
+        self.mapper = mapper
+        self.combiner = combiner
+        self.num_slaves = 0
+        
+        self._listener = Listener(address, authkey=self.authkey)
+        self._accepter = None
+        self._results = queue.Queue()
+        
+        self._tasks = None
+        self._read_lock = threading.Lock()
+        self._retry = deque()
+        self._pending = 0
+        self._exhausted = False
+        self._finished = False
+        self._closed = False
+        self._cond = threading.Condition()
+    
+    @property
+    def address(self):
+        '''The (host, port) the coordinator listens at'''
+        return self._listener.address
+    
+    def _finish_if_done(self):
+        '''Signals the end of the results, called with the lock held'''
+        if self._exhausted and not self._pending and not self._retry and \
+                not self._finished:
+            self._finished = True
+            self._results.put(None)
+            self._cond.notify_all()
+    
+    def _next_tasks(self, chunk_size):
+        '''Returns the next list of tasks for a slave, None at the end'''
+        while True:
+            with self._cond:
+                while not self._closed and not self._retry and \
+                        self._exhausted and not self._finished:
+                    #a slave which disconnects may return its tasks
+                    self._cond.wait()
+                
+                if self._closed or self._finished:
+                    return None
+                
+                self._pending += 1
+                if self._retry:
+                    return self._retry.popleft()
+            
+            #tasks may block (e.g. throttled), the lock is not held
+            with self._read_lock:
+                tasks = list(islice(self._tasks, chunk_size))
+            
+            if tasks:
+                return tasks
+            
+            with self._cond:
+                self._pending -= 1
+                self._exhausted = True
+                self._finish_if_done()
+    
+    def _serve(self, conn, helper, chunk_size):
+        '''Sends tasks to a slave until there are no more'''
+        tasks = None
+        try:
+            conn.send((self.mapper, self.combiner))
+            while True:
+                tasks = self._next_tasks(chunk_size)
+                conn.send(tasks if tasks is None else (helper, tasks))
+                if tasks is None:
+                    return
+                
+                results, error = conn.recv()
+                self._results.put((results, error))
+                with self._cond:
+                    tasks = None
+                    self._pending -= 1
+                    self._finish_if_done()
+        except (EOFError, IOError, socket.error):
+            if tasks is not None:
+                print('Lost a remote slave, sending its tasks again', 
+                      file=sys.stderr)
+                with self._cond:
+                    self._retry.append(tasks)
+                    self._pending -= 1
+                    self._cond.notify_all()
+        finally:
+            conn.close()
+    
+    def _accept(self, helper, chunk_size):
+        '''Serves each slave which connects in a new thread'''
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception: #authentication errors or closed listener
+                if self._closed:
+                    return
+                continue
+            
+            if self._closed:
+                conn.close()
+                return
+            
+            self.num_slaves += 1
+            server = threading.Thread(target=self._serve, 
+                                      args=(conn, helper, chunk_size))
+            server.daemon = True
+            server.start()
+    
+    def imap_unordered(self, helper, tasks, chunk_size = 1):
+        '''Same as `Pool.imap_unordered`, tasks are mapped remotely'''
+        host, port = self.address
+        print('Waiting for slaves at %s:%d' % (host, port), file=sys.stderr)
+        
+        self._tasks = iter(tasks)
+        self._accepter = threading.Thread(target=self._accept, 
+                                          args=(helper, chunk_size))
+        self._accepter.daemon = True
+        self._accepter.start()
+        
+        for results, error in iter(self._results.get, None):
+            if error is not None:
+                raise RuntimeError('Remote slave failed:\n%s' % error)
+            for result in results:
+                yield result
+    
+    def close(self):
+        '''Stops sending tasks and listening for slaves'''
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        
+        if self._accepter is not None:
+            #wakes up the thread waiting for slaves
+            try:
+                Client(self.address, authkey=self.authkey).close()
+            except Exception:
+                pass
+            self._accepter.join()
+        self._listener.close()
+    
+    def terminate(self):
+        self.close()
+    
+    def join(self):
+        pass
+
+def _connect(address, authkey, timeout):
+    '''Connects to a coordinator, retrying until `timeout` seconds pass'''
+    start = time.time()
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except socket.error:
+            if time.time() - start > timeout:
+                raise
+            time.sleep(0.1)
+
+def _remote_slave(address, authkey, timeout):
+    '''
+    Main loop of a remote slave, installs the mapper sent by the 
+    coordinator and maps every list of tasks received until None.
+    '''
+    conn = _connect(address, authkey, timeout)
+    try:
+        mapper, combiner = conn.recv()
+        _install_mapper(mapper, combiner)
+        for helper, tasks in iter(conn.recv, None):
+            try:
+                conn.send(([helper(task) for task in tasks], None))
+            except Exception:
+                conn.send((None, traceback.format_exc()))
+    except EOFError: #the coordinator stopped
+        pass
+    finally:
+        conn.close()
+
+def _worker_main(args):
+    '''Command line of `run_worker`'''
+    parser = argparse.ArgumentParser(prog='vod.mapreducescript',
+                                     description='Remote slave of a runner '
+                                                 'with the remote backend')
+    parser.add_argument('coordinator', type=_address,
+                        help='Address of the coordinator, host:port')
+    parser.add_argument('--authkey', type=str, 
+                        default=os.environ.get('VOD_AUTHKEY'),
+                        help='Authentication key (VOD_AUTHKEY)')
+    parser.add_argument('--num_procs', type=int, default=1,
+                        help='Number of slave processes (1)')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Seconds to wait for the coordinator (60)')
+    arg_vals = parser.parse_args(args)
+    run_worker(arg_vals.coordinator, arg_vals.authkey, arg_vals.num_procs,
+               arg_vals.timeout)
+
+def _run_coroutines(igen, mapper, reducer, max_pending):
+    '''
+    Maps the items with an asyncio event loop. The mapper may return
+    coroutines (or other awaitables), at most `max_pending` of them are
+    run at once. Other values are reduced right away. Values are reduced
+    as their coroutines finish.
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        keys = {}
+        pending = set()
+        
+        def _reduce_done(pending):
+            '''Waits for at least one coroutine, reduces the finished ones'''
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                reducer(keys.pop(task), task.result())
+            return pending
+        
+        for key, item in igen:
+            value = mapper(key, item)
+            if not inspect.isawaitable(value):
+                reducer(key, value)
+                continue
+            
+            task = asyncio.ensure_future(value, loop=loop)
+            keys[task] = key
+            pending.add(task)
+            if len(pending) >= max_pending:
+                pending = _reduce_done(pending)
+        
+        while pending:
+            pending = _reduce_done(pending)
+    finally:
+        for task in keys:
+            task.cancel()
+        loop.close()
+
+class _Installed(threading.local):
+    '''
+    Objects installed in each slave by `_install_mapper`. Slaves of the
+    thread backend are threads of the master, so the objects are kept per
+    thread and runners using thread pools at the same time (e.g., 
+    overlapped `Pipeline` stages) do not overwrite each other's mapper.
+    '''
+    mapper = None
+    combiner = None
+    partitions = None
+    reader = None
+
+_WORKER = _Installed()
+
+#Run and mapper file loaded by the slave process of a `WorkerPool`
+_WORKER_INSTALLED = None
+
+def _warm_worker(imports):
+    '''Pool initializer of a `WorkerPool`, imports the modules given'''
+    for module in imports:
+        importlib.import_module(module)
+
+def _shared_helper(args):
+    '''
+    Helper for the use of a `WorkerPool`. Installs the mapper from its file
+    when a new one is seen, then calls the helper with the task.
+    '''
+    global _WORKER_INSTALLED
+    installed, helper, task = args
+    if installed is not None and installed != _WORKER_INSTALLED:
+        with open(installed[1], 'rb') as mapper_file:
+            mapper, combiner = pickle.load(mapper_file)
+        _install_mapper(mapper, combiner)
+        _WORKER_INSTALLED = installed
+    
+    return helper(task)
+
+def _install_mapper(mapper, combiner = None, partitions = None, 
+                    profile_prefix = None, reader = None):
+    '''
+    Pool initializer which keeps the mapper in the slave (see `_Installed`),
+    and the runner which reads input splits (`reader`). Also starts
+    profiling the slave if a `profile_prefix` is given.
+    '''
+    _WORKER.mapper = mapper
+    _WORKER.combiner = combiner
+    _WORKER.partitions = partitions
+    _WORKER.reader = reader
+    
+    if profile_prefix:
+        _start_profiler(profile_prefix)
+
+def _start_profiler(profile_prefix):
+    '''
+    Profiles the current process until it exits, the results are saved to
+    `<profile_prefix>.worker-<pid>.prof`.
+    '''
+    profiler = profile.Profile()
+    path = '%s.worker-%d.prof' % (profile_prefix, os.getpid())
+    
+    def _dump():
+        '''Saves the profile, called when the process exits'''
+        profiler.disable()
+        profiler.dump_stats(path)
+    
+    Finalize(None, _dump, exitpriority=10)
+    profiler.enable()
+
+def _chunk_generator(igen, chunk_size):
+    '''Groups the (key, item) tuples of `igen` in lists of `chunk_size`'''
+    chunk = []
+    for key_item in igen:
+        chunk.append(key_item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    
+    if chunk:
+        yield chunk
+
+def _map_chunk(mapper, combiner, chunk):
+    '''
+    Maps every item in the chunk, in a single call for batch mappers,
+    and combines the values of each key if a combiner is given. 
+    Returns a list of (key, value) tuples.
+    '''
+    if isinstance(mapper, BaseBatchMapper):
+        keys = [key for key, _ in chunk]
+        items = [item for _, item in chunk]
+        mapped = list(zip(keys, mapper.map_batch(keys, items)))
+    else:
+        mapped = [(key, mapper(key, item)) for key, item in chunk]
+    
+    if combiner is None:
+        return mapped
+    
+    #failed items are not combined
+    failed = []
+    if isinstance(mapper, _SafeMapper):
+        failed = [(key, value) for key, value in mapped 
+                  if isinstance(value, _Failure)]
+        if failed:
+            mapped = [(key, value) for key, value in mapped 
+                      if not isinstance(value, _Failure)]
+    
+    values = {}
+    for key, value in mapped:
+        values.setdefault(key, []).append(value)
+    
+    return [(key, combiner(key, key_values)) 
+            for key, key_values in values.items()] + failed
+
+def _chunk_processor_helper(chunk):
+    '''Helper for the use of multiprocessing with chunks of items'''
+    return _map_chunk(_WORKER.mapper, _WORKER.combiner, chunk)
+
+def _instrumented_map_chunk(mapper, combiner, chunk):
+    '''
+    Same as `_map_chunk`, but returns the tuple: (number of items, time
+    taken, mapped values, dict with stats of the slave). See `_RunStats`.
+    '''
+    start = time.time()
+    if isinstance(mapper, BaseBatchMapper):
+        timed = None
+        mapped = _map_chunk(mapper, combiner, chunk)
+    else:
+        timed = _TimedMapper(mapper)
+        mapped = _map_chunk(timed, combiner, chunk)
+    elapsed = time.time() - start
+    
+    if timed is None:
+        timed = _TimedMapper(mapper)
+        if chunk:
+            timed.add(elapsed / len(chunk), len(chunk))
+    
+    worker = {'pid': os.getpid(), 
+              'latency': timed.latency,
+              'bytes_in': len(pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)),
+              'bytes_out': len(pickle.dumps(mapped, pickle.HIGHEST_PROTOCOL))}
+    return len(chunk), elapsed, mapped, worker
+
+def _instrumented_chunk_processor_helper(chunk):
+    '''Same as `_chunk_processor_helper`, also returns stats of the slave'''
+    return _instrumented_map_chunk(_WORKER.mapper, _WORKER.combiner, chunk)
+
+def _timed_chunk_processor_helper(chunk):
+    '''Same as `_chunk_processor_helper`, also returns the time taken'''
+    start = time.time()
+    mapped = _map_chunk(_WORKER.mapper, _WORKER.combiner, chunk)
+    return len(chunk), time.time() - start, mapped
+
+def _processor_helper(tup):
+    '''Helper for the use of multiprocessing'''
+    key, item = tup
+    return key, _WORKER.mapper(key, item)
+
+def _numbered_helper(args):
+    '''
+    Helper for `_ReorderBuffer`, returns the tuple: (position, result, 
+    exception raised or None).
+    '''
+    helper, position, task = args
+    try:
+        return position, helper(task), None
+    except Exception as error:
+        return position, None, error
+
+def _map_tasks(args):
+    '''Maps a list of tasks with a helper, see `_SpeculativePool`'''
+    helper, tasks = args
+    return [helper(task) for task in tasks]
+
+def _item_processor_helper(tup):
+    '''Helper for the use of multiprocessing, mapper is sent with the item'''
+    mapper, key, item = tup
+    return key, mapper(key, item)
+
+def _partition_of(key, num_partitions):
+    '''
+    Partition of a key. `hash` of strings changes with each process in
+    Python 3 (slaves may be spawned), so a checksum of the pickled key is
+    used instead. Equal keys must be pickled the same way.
+    '''
+    #a fixed protocol, crc32 may be negative in Python 2
+    checksum = zlib.crc32(pickle.dumps(key, 2)) & 0xffffffff
+    return checksum % num_partitions
+
+def _partition_chunk(mapper, combiner, partitions, chunk):
+    '''
+    Maps a chunk and sends the results to the queues in `partitions`
+    according to the key (see `_partition_of`). Returns the list of (key, 
+    `_Failure`) tuples of the items which failed, these are not sent.
+    '''
+    num_partitions = len(partitions)
+    buffers = [[] for _ in range(num_partitions)]
+    failed = []
+    for key, value in _map_chunk(mapper, combiner, chunk):
+        if isinstance(value, _Failure):
+            failed.append((key, value))
+        else:
+            buffers[_partition_of(key, num_partitions)].append((key, value))
+    
+    for partition, buff in enumerate(buffers):
+        if buff:
+            partitions[partition].put(buff)
+    
+    return failed
+
+def _partition_processor_helper(chunk):
+    '''Helper for the use of multiprocessing with partitioned reducers'''
+    return _partition_chunk(_WORKER.mapper, _WORKER.combiner, 
+                            _WORKER.partitions, chunk)
+
+def _timed_partition_processor_helper(chunk):
+    '''Same as `_partition_processor_helper`, also returns the time taken'''
+    start = time.time()
+    failed = _partition_processor_helper(chunk)
+    return len(chunk), time.time() - start, failed
+
+def _split_processor_helper(task):
+    '''
+    Helper for the use of multiprocessing with input splits. Reads the
+    items of the split with the installed runner, mapping them in batches
+    which are sent to the partitions (see `_partition_chunk`). Returns the
+    list of items which failed.
+    '''
+    split, batch_size = task
+    failed = []
+    items = _WORKER.reader.read_split(split)
+    for chunk in _chunk_generator(items, batch_size):
+        failed.extend(_partition_chunk(_WORKER.mapper, _WORKER.combiner, 
+                                       _WORKER.partitions, chunk))
+    return failed
+
+def _reduce_partition(runner, partition, queue, states, spill_after = None,
+                      spill_dir = None, profile_prefix = None):
+    '''
+    Main loop of a reducer process. Reduces every batch of values
+    in `queue` until None is found, the state of the partition is then
+    pickled and put in the `states` queue. If `spill_after` is given,
+    values are reduced in key order using an `_ExternalSorter`. The 
+    process is profiled if a `profile_prefix` is given. If reducing 
+    fails, the error is put in `states` and the rest of the queue is read
+    and ignored, otherwise the mappers would wait for it forever.
+    '''
+    if profile_prefix:
+        _start_profiler(profile_prefix)
+    
+    sorter = None
+    finished = False
+    try:
+        reducer = runner.reducer()
+        reduc = reducer
+        if spill_after:
+            sorter = _ExternalSorter(spill_after, spill_dir)
+            reduc = sorter
+        
+        #values may be arrays shared by the slaves
+        reduc = _ArrayLoader(reduc)
+        for batch in iter(queue.get, None):
+            for key, value in batch:
+                reduc(key, value)
+        finished = True
+        
+        if sorter is not None:
+            sorter.reduce(reducer)
+        
+        state = runner.reducer_state(reducer)
+        states.put((partition, pickle.dumps(state, pickle.HIGHEST_PROTOCOL), 
+                    None))
+    except Exception:
+        states.put((partition, None, traceback.format_exc()))
+        if not finished:
+            for _ in iter(queue.get, None):
+                pass
+    finally:
+        if sorter is not None:
+            sorter.close()
+
+if __name__ == '__main__':
+    #the module is imported again so that pickled classes match
+    from vod.mapreducescript import _worker_main
+    sys.exit(_worker_main(sys.argv[1:]))
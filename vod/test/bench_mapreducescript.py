@@ -0,0 +1,159 @@
+# -*- coding: utf8
+'''
+Benchmarks for the map-reduce module. These are not run with the tests,
+execute them with:
+
+    python -m vod.test.bench_mapreducescript
+'''
+
+from __future__ import division, print_function
+
+from vod.mapreducescript import BaseMapper
+from vod.mapreducescript import Runner
+from vod.mapreducescript import WorkerPool
+
+import numpy as np
+import pickle
+import sys
+import time
+
+class LookupMapper(BaseMapper):
+    '''Mapper which holds a large lookup table'''
+    
+    def __init__(self, table_size):
+        self.table = dict((i, i) for i in xrange(table_size))
+    
+    def _map(self, key, item):
+        return self.table[item % len(self.table)]
+
+class BenchRunner(Runner):
+    '''Runner over `num_items` integers with a `LookupMapper`'''
+    
+    def __init__(self, num_items, table_size):
+        super(BenchRunner, self).__init__('Bench', 'Benchmark')
+        self.num_items = num_items
+        self.proc = LookupMapper(table_size)
+        self.total = 0
+    
+    def item_generator(self):
+        return ((i, i) for i in xrange(self.num_items))
+    
+    def mapper(self):
+        return self.proc
+    
+    def reducer(self):
+        def _reduc(key, value):
+            self.total += value
+        return _reduc
+
+def _timeit(func):
+    '''Returns the wall clock time taken by `func`'''
+    start = time.time()
+    func()
+    return time.time() - start
+
+def bench_install_mapper(num_procs=4, num_items=20000, table_size=10000,
+                         chunk_size=100):
+    '''
+    Compares sending the mapper with every item against installing it
+    once in each slave process.
+    '''
+    print('# install_mapper: %d items, table of %d entries' % \
+          (num_items, table_size))
+    print('#mode', 'bytes_per_item', 'seconds', 'us_per_item')
+    
+    mapper = LookupMapper(table_size)
+    per_item = len(pickle.dumps((mapper, 0, 0), pickle.HIGHEST_PROTOCOL))
+    installed = len(pickle.dumps((0, 0), pickle.HIGHEST_PROTOCOL))
+    
+    for name, install, num_bytes in (('per_item', False, per_item), 
+                                     ('installed', True, installed)):
+        runner = BenchRunner(num_items, table_size)
+        took = _timeit(lambda: runner._go(num_procs, chunk_size, 
+                                          install_mapper=install))
+        print(name, num_bytes, took, 1e6 * took / num_items)
+
+class ImportingMapper(BaseMapper):
+    '''Mapper which imports scipy.stats when called, as lazy code does'''
+    
+    def _map(self, key, item):
+        import scipy.stats
+        return scipy.stats.norm.cdf(item)
+
+class SmallRunner(BenchRunner):
+    '''A short run with an `ImportingMapper`'''
+    
+    def __init__(self, num_items):
+        super(SmallRunner, self).__init__(num_items, 1)
+        self.proc = ImportingMapper()
+
+def bench_worker_pool(num_procs=4, num_runs=10, num_items=1000):
+    '''
+    Compares running several small runners, each one starting its own 
+    processes, against sharing a `WorkerPool` with scipy already imported.
+    '''
+    print('# worker_pool: %d runs of %d items' % (num_runs, num_items))
+    print('#mode', 'seconds', 'seconds_per_run')
+    
+    def fresh():
+        for _ in xrange(num_runs):
+            SmallRunner(num_items)([str(num_procs)])
+    
+    def shared():
+        with WorkerPool(num_procs, ['scipy.stats']) as pool:
+            for _ in xrange(num_runs):
+                SmallRunner(num_items)([str(num_procs)], pool)
+    
+    for name, func in (('fresh', fresh), ('shared', shared)):
+        took = _timeit(func)
+        print(name, took, took / num_runs)
+
+class VectorMapper(BaseMapper):
+    '''Mapper which returns an array of `size` floats'''
+    
+    def __init__(self, size):
+        self.size = size
+    
+    def _map(self, key, item):
+        return np.full(self.size, item, dtype='d')
+
+class VectorRunner(BenchRunner):
+    '''Runner over `num_items` integers with a `VectorMapper`'''
+    
+    def __init__(self, num_items, size):
+        super(VectorRunner, self).__init__(num_items, 1)
+        self.proc = VectorMapper(size)
+    
+    def reducer(self):
+        def _reduc(key, value):
+            self.total += value[-1]
+        return _reduc
+
+def bench_shared_arrays(num_procs=4, total_mb=800, 
+                        sizes=(1000, 10000, 100000, 1000000, 4000000)):
+    '''
+    Compares pickling mapped arrays through the pipe against sharing them
+    with memory mapped files, for arrays of each of the `sizes` (floats).
+    About `total_mb` are mapped for each size.
+    '''
+    print('# shared_arrays: %d MB per size' % total_mb)
+    print('#mode', 'array_bytes', 'items', 'seconds', 'mb_per_second')
+    
+    for size in sizes:
+        num_bytes = 8 * size
+        num_items = max(total_mb * 2 ** 20 // num_bytes, 10)
+        for name, args in (('pickled', []),
+                           ('shared', ['--share_arrays_above', '0'])):
+            runner = VectorRunner(num_items, size)
+            took = _timeit(lambda: runner([str(num_procs)] + args))
+            print(name, num_bytes, num_items, took, 
+                  num_items * num_bytes / 2 ** 20 / took)
+
+def main():
+    '''Runs all benchmarks'''
+    bench_install_mapper()
+    bench_worker_pool()
+    bench_shared_arrays()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,7 +4,11 @@ from __future__ import print_function, division
 from vod import entropy
 
 import numpy as np
+import scipy.sparse as sp
 import math
+import os
+import shutil
+import tempfile
 import unittest
 
 #Calculates the entropy iteratively.
@@ -47,6 +51,105 @@ class TestEntropy(unittest.TestCase):
         except AssertionError:
             pass
 
+    def test_entropy_axis(self):
+        probs = np.array([[0.1, 0.5, 0.01, 0.07, 0.02, 0.3, 0, 0, 0],
+                          [1, 0, 0, 0, 0, 0, 0, 0, 0],
+                          [0.5, 0, 0, 0, 0, 0, 0, 0.5, 0],
+                          [0, 0, 0, 0, 0, 0, 0, 0, 0]], dtype='d')
+
+        expected = [it_entropy(row) for row in probs]
+        self.assertTrue(np.allclose(entropy.entropy(probs, axis=1),
+                                    expected))
+        self.assertTrue(np.allclose(entropy.entropy(probs.T, axis=0),
+                                    expected))
+
+        sparse = sp.csr_matrix(probs)
+        self.assertTrue(np.allclose(entropy.entropy(sparse, axis=1),
+                                    expected))
+        self.assertTrue(np.allclose(entropy.entropy(sparse.T, axis=0),
+                                    expected))
+        self.assertAlmostEqual(entropy.entropy(sparse), sum(expected))
+
+        try:
+            entropy.entropy(sp.csr_matrix([[0.5, 2]]), axis=1)
+            self.fail()
+        except AssertionError:
+            pass
+
+    def test_mi_axis(self):
+        x_probs = np.array([[0.04, 0.16] * 5, [0.1] * 10, [1] + [0] * 9])
+        xy_probs = np.array([[0.02, 0.18] * 5, [0.04, 0.16] * 5,
+                             [0.02, 0.18] * 5])
+
+        mutual_inf = entropy.mutual_information(x_probs, xy_probs, axis=1)
+        norm_mutual_inf = entropy.norm_mutual_information(x_probs, xy_probs,
+                                                          axis=1)
+        sparse_norm_mutual_inf = \
+                entropy.norm_mutual_information(sp.csr_matrix(x_probs),
+                                                sp.csr_matrix(xy_probs),
+                                                axis=1)
+
+        for i in range(len(x_probs)):
+            h_x = it_entropy(x_probs[i])
+            h_y = it_entropy(xy_probs[i])
+            self.assertAlmostEqual(mutual_inf[i], h_x - h_y)
+
+            expected = 0
+            if h_x > 0 and h_y > 0:
+                expected = 1 - (h_x - h_y) / h_x
+            self.assertAlmostEqual(norm_mutual_inf[i], expected)
+            self.assertAlmostEqual(sparse_norm_mutual_inf[i], expected)
+
+    def test_streaming(self):
+        counts = np.array([10, 50, 1, 7, 2, 30, 0, 0, 0], dtype='d')
+        expected = it_entropy(counts / counts.sum())
+
+        estimator = entropy.StreamingEntropy()
+        self.assertEqual(estimator.entropy(), 0)
+        for chunk in np.array_split(counts, 4):
+            estimator.add_counts(chunk)
+        self.assertAlmostEqual(estimator.entropy(), expected)
+        self.assertEqual(estimator.total, counts.sum())
+        self.assertEqual(estimator.counts, {})
+
+        events = np.repeat(np.arange(len(counts)), counts.astype('i'))
+        np.random.shuffle(events)
+
+        estimator = entropy.StreamingEntropy()
+        for chunk in np.array_split(events, 7):
+            estimator.add_events(chunk)
+        self.assertAlmostEqual(estimator.entropy(), expected)
+
+        estimator = entropy.StreamingEntropy()
+        estimator.add_counts([5, 20, 3], ['a', 'b', 'a'])
+        estimator.add_counts([8], ['a'])
+        self.assertAlmostEqual(estimator.entropy(),
+                               it_entropy([16 / 36, 20 / 36]))
+
+        try:
+            estimator.add_counts([-1])
+            self.fail()
+        except AssertionError:
+            pass
+
+    def test_streaming_merge(self):
+        events = np.random.randint(0, 20, 1000)
+        single = entropy.StreamingEntropy().add_events(events)
+
+        workers = [entropy.StreamingEntropy().add_events(chunk)
+                   for chunk in np.array_split(events, 3)]
+        merged = entropy.StreamingEntropy()
+        for worker in workers:
+            merged.merge(worker)
+
+        self.assertAlmostEqual(merged.entropy(), single.entropy())
+        self.assertEqual(merged.total, 1000)
+        self.assertEqual(merged.counts, single.counts)
+
+        anonymous = entropy.StreamingEntropy().add_counts([1, 1])
+        keyed = entropy.StreamingEntropy().add_counts([1, 1], [0, 1])
+        self.assertAlmostEqual(anonymous.merge(keyed).entropy(), 2)
+
     def test_norm_mi(self):
         x_probs = np.array([0.04, 0.16] * 5)
         xy_probs = np.array([0.02, 0.18] * 5)
@@ -105,3 +208,101 @@ class TestEntropy(unittest.TestCase):
         self.assertAlmostEqual(entropy.kullback_leiber_divergence(x_probs, 
                                                                   xy_probs), 
                                float('inf'))
+
+    def test_kl4(self):
+        #zeros of p do not matter, only zeros of q where p is non zero
+        x_probs = np.array([0.5, 0.5, 0])
+        xy_probs = np.array([0.25, 0.25, 0.5])
+
+        self.assertAlmostEqual(entropy.kullback_leiber_divergence(x_probs,
+                                                                  xy_probs),
+                               1)
+        self.assertEqual(entropy.kullback_leiber_divergence(xy_probs,
+                                                            x_probs),
+                         float('inf'))
+
+    def test_pairwise_kl(self):
+        probs = np.random.RandomState(7).rand(10, 6)
+        probs[probs < 0.2] = 0
+        probs[3] = probs[4]
+        probs[-1] = 0
+        probs[-1, 0] = 1
+        probs[-2] = [0.5, 0.5, 0, 0, 0, 0]
+        probs[-3] = [0.25, 0.25, 0.5, 0, 0, 0]
+        probs /= probs.sum(axis=1)[:, np.newaxis]
+
+        expected = np.array([[entropy.kullback_leiber_divergence(p, q)
+                              for q in probs] for p in probs])
+        self.assertAlmostEqual(expected[-2, -3], 1)
+
+        for block_size in [None, 1, 3, 20]:
+            dkl = entropy.pairwise_divergence(probs, 'kl', block_size)
+            self.assertEqual(dkl.shape, (10, 10))
+            self.assertTrue((np.isinf(dkl) == np.isinf(expected)).all())
+            finite = ~np.isinf(expected)
+            self.assertTrue(np.allclose(dkl[finite], expected[finite]))
+            self.assertAlmostEqual(dkl[3, 4], 0)
+            self.assertTrue((np.diag(dkl) == 0).all())
+            self.assertTrue((dkl >= 0).all())
+
+        #KL temporaries grow with the number of distributions
+        self.assertEqual(entropy._block_size(3000, 4, None, 'kl'),
+                         2 ** 22 // 3000)
+        self.assertEqual(entropy._block_size(3000, 4, None, 'js'), 1024)
+
+    def test_pairwise_js(self):
+        probs = np.random.RandomState(7).rand(7, 5)
+        probs[probs < 0.2] = 0
+        probs[0] = [1, 0, 0, 0, 0]
+        probs[1] = [0, 1, 0, 0, 0]
+        probs /= probs.sum(axis=1)[:, np.newaxis]
+
+        expected = np.zeros((7, 7))
+        for i, p in enumerate(probs):
+            for j, q in enumerate(probs):
+                m = (p + q) / 2
+                expected[i, j] = (0.5 * sum(p[k] * math.log(p[k] / m[k], 2)
+                                            for k in range(5) if p[k]) +
+                                  0.5 * sum(q[k] * math.log(q[k] / m[k], 2)
+                                            for k in range(5) if q[k]))
+
+        for block_size in [None, 1, 2, 10]:
+            djs = entropy.pairwise_divergence(probs, 'js', block_size)
+            self.assertTrue(np.allclose(djs, expected))
+            self.assertTrue((djs == djs.T).all())
+            self.assertTrue((np.diag(djs) == 0).all())
+            self.assertAlmostEqual(djs[0, 1], 1)
+
+        try:
+            entropy.pairwise_divergence(probs, 'foo')
+            self.fail()
+        except ValueError:
+            pass
+
+    def test_pairwise_memmap(self):
+        probs = np.random.RandomState(7).rand(6, 4)
+        probs /= probs.sum(axis=1)[:, np.newaxis]
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'js.npy')
+            djs = entropy.pairwise_divergence(probs, 'js', 4, path)
+            self.assertTrue(isinstance(djs, np.memmap))
+            del djs
+
+            loaded = np.load(path, mmap_mode='r')
+            self.assertTrue(np.allclose(
+                loaded, entropy.pairwise_divergence(probs, 'js')))
+            del loaded
+
+            path = os.path.join(tmp_dir, 'kl.npy')
+            dkl = entropy.pairwise_divergence(probs, out_path=path)
+            self.assertTrue(isinstance(dkl, np.memmap))
+            del dkl
+
+            loaded = np.load(path, mmap_mode='r')
+            self.assertTrue(np.allclose(
+                loaded, entropy.pairwise_divergence(probs, 'kl', 1)))
+            del loaded
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -3,11 +3,54 @@
 
 from __future__ import division, print_function
 
+from vod.mapreducescript import BaseBatchMapper
+from vod.mapreducescript import BaseCombiner
 from vod.mapreducescript import BaseMapper
+from vod.mapreducescript import BaseReducer
+from vod.mapreducescript import Pipeline
 from vod.mapreducescript import Runner 
+from vod.mapreducescript import WorkerPool
+from vod.mapreducescript import estimate_lines
+from vod.mapreducescript import read_quarantine
+from vod.mapreducescript import run_worker
+from vod.mapreducescript import asyncio
+from vod.mapreducescript import _ChunkSizeTuner
+from vod.mapreducescript import _ExternalSorter
+from vod.mapreducescript import _InFlightLimiter
+from vod.mapreducescript import _MemoryMonitor
+from vod.mapreducescript import _POOLS
+from vod.mapreducescript import _Progress
+from vod.mapreducescript import _RecyclingPool
+from vod.mapreducescript import _ReorderBuffer
+from vod.mapreducescript import _SpeculativePool
+from vod.mapreducescript import _processor_helper
+from vod.mapreducescript import _install_mapper
+from multiprocessing import Pool
+from multiprocessing import Process
+from multiprocessing.pool import Pool as BasePool
+from multiprocessing.pool import ThreadPool
 
+import glob
+import gzip
+import json
+import numpy as np
+import os
+import pickle
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+try:
+    from StringIO import StringIO
+except ImportError: #python 3
+    from io import StringIO
+
 class RunnerTest(unittest.TestCase):
     '''Tests the Runner class'''
     
@@ -45,6 +88,844 @@ class RunnerTest(unittest.TestCase):
                     
         self.assertEquals(r1.result_store, r2.result_store)
 
+    def testMapperPerItem(self):
+        r1 = BasicRunner()
+        r1(['4', '--mapper_per_item'])
+        self.assertEquals(100, len(r1.result_store))
+        
+        r2 = BasicRunner()
+        r2(['4'])
+        self.assertEquals(r1.result_store, r2.result_store)
+        
+        for k, v in r1.result_store.items():
+            self.assertEquals(k, v - 1)
+
+    def testCombiner(self):
+        r1 = CountRunner()
+        r1(['4', '--chunk_size', '50'])
+        
+        r2 = CountRunner()
+        r2(['1'])
+        
+        expected = dict((k, 100) for k in xrange(10))
+        self.assertEquals(expected, r1.result_store)
+        self.assertEquals(expected, r2.result_store)
+        
+        #at most one value per key per chunk reaches the reducer
+        self.assertEquals(200, r1.num_reduced)
+        self.assertEquals(100, r2.num_reduced)
+
+    def testBatchMapper(self):
+        for args in (['4', '--batch_size', '7'], ['1'], ['4']):
+            r = BatchRunner()
+            r(args)
+            self.assertEquals(100, len(r.result_store))
+            
+            for k, v in r.result_store.items():
+                self.assertEquals(k, v - 1)
+        
+        r = BatchRunner()
+        r(['1', '--batch_size', '30'])
+        self.assertEquals([30, 30, 30, 10], r.proc.batch_sizes)
+
+    def testPartitionedReducers(self):
+        for args in (['4', '--num_reducers', '3'], 
+                     ['1', '--num_reducers', '3'],
+                     ['4', '--num_reducers', '2', '--batch_size', '7']):
+            r = PartitionRunner()
+            r(args)
+            self.assertEquals(100, len(r.result_store))
+            self.assertTrue(len(r.partition_sizes) > 1)
+            self.assertEquals(100, sum(r.partition_sizes))
+            
+            for k, v in r.result_store.items():
+                self.assertEquals(k, v - 1)
+
+    def testPartitionOf(self):
+        #string hashes change across processes with PYTHONHASHSEED
+        code = ('from vod.mapreducescript import _partition_of\n'
+                'print([_partition_of("key-%d" % i, 3) for i in range(50)])')
+        outputs = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.check_output([sys.executable, '-c', code],
+                                                env=env))
+        self.assertEquals(1, len(outputs))
+
+    def testMaxInFlight(self):
+        for runner, args in \
+                ((BasicRunner, ['4', '--max_in_flight', '20', 
+                                '--batch_size', '5']),
+                 (BasicRunner, ['4', '--max_in_flight_bytes', '100']),
+                 (PartitionRunner, ['4', '--max_in_flight', '10', 
+                                    '--num_reducers', '2'])):
+            r = runner()
+            r(args)
+            self.assertEquals(100, len(r.result_store))
+            
+            for k, v in r.result_store.items():
+                self.assertEquals(k, v - 1)
+
+    def testAutoChunkSize(self):
+        for runner, args in ((BasicRunner, ['4', '--chunk_size', 'auto']),
+                             (BasicRunner, ['1', '--chunk_size', 'auto']),
+                             (PartitionRunner, ['4', '--chunk_size', 'auto',
+                                                '--num_reducers', '2'])):
+            r = runner()
+            r(args)
+            self.assertEquals(100, len(r.result_store))
+            
+            for k, v in r.result_store.items():
+                self.assertEquals(k, v - 1)
+        
+        #chunks are measured in the slaves, items are mapped only once
+        r = BasicRunner()
+        r.proc = CountingProcessor()
+        r(['4', '--chunk_size', 'auto', '--backend', 'thread'])
+        self.assertEquals(100, len(r.result_store))
+        self.assertEquals(100, r.proc.calls)
+
+    def testSpill(self):
+        for args in (['4', '--spill_after', '7'], ['1', '--spill_after', '7'],
+                     ['4', '--spill_after', '1000', '--chunk_size', '3']):
+            r = OrderRunner()
+            r(args)
+            self.assertEquals(100, len(r.result_store))
+            self.assertEquals(list(range(100)), r.keys)
+            
+            for k, v in r.result_store.items():
+                self.assertEquals(k, v - 1)
+        
+        r = PartitionRunner()
+        r(['4', '--spill_after', '7', '--num_reducers', '3'])
+        self.assertEquals(100, len(r.result_store))
+
+    def testCheckpoint(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for num_procs in ('1', '4'):
+                path = os.path.join(tmp_dir, 'checkpoint')
+                args = [num_procs, '--checkpoint', path, 
+                        '--checkpoint_every', '10', '--batch_size', '5']
+                
+                r1 = CheckpointRunner(fail_key = 63)
+                r1(args)
+                self.assertTrue(os.path.exists(path))
+                
+                r2 = CheckpointRunner()
+                r2(args + ['--resume'])
+                self.assertFalse(os.path.exists(path))
+                
+                #only the items after the checkpoint were mapped
+                self.assertEquals(40, r2.num_reduced)
+                self.assertEquals(100, len(r2.reduc.store))
+                for k, v in r2.reduc.store.items():
+                    self.assertEquals(k, v - 1)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testStats(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for args in (['4'], ['1'], ['4', '--chunk_size', 'auto']):
+                path = os.path.join(tmp_dir, 'stats')
+                r = BasicRunner()
+                r(args + ['--stats_file', path, '--batch_size', '10'])
+                self.assertEquals(100, len(r.result_store))
+                
+                with open(path) as stats_file:
+                    stats = json.loads(stats_file.readlines()[-1])
+                os.remove(path)
+                
+                self.assertEquals(100, stats['items_generated'])
+                self.assertEquals(100, stats['items_mapped'])
+                self.assertEquals(100, sum(stats['items_per_worker'].values()))
+                self.assertEquals(100, sum(stats['map_latency'].values()))
+                self.assertTrue(stats['bytes_in'] > 0)
+                self.assertTrue(stats['bytes_out'] > 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testProfileWorkers(self):
+        tmp_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(tmp_dir)
+            r = BasicRunner()
+            r(['3', '--profile'])
+            self.assertEquals(100, len(r.result_store))
+            
+            self.assertEquals(3, len(glob.glob('.run_profile.worker-*.prof')))
+            self.assertTrue(os.path.exists('.run_profile.all.prof'))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp_dir)
+
+    def testThreadBackend(self):
+        for args in (['4'], ['4', '--batch_size', '3'], 
+                     ['4', '--max_in_flight', '10']):
+            r = BasicRunner()
+            #threads do not need a picklable mapper
+            r.proc = lambda key, item: item + 1
+            r(args + ['--backend', 'thread'])
+            self.assertEquals(100, len(r.result_store))
+            
+            for k, v in r.result_store.items():
+                self.assertEquals(k, v - 1)
+    
+    def testSerialBackend(self):
+        r = BasicRunner()
+        r.proc = lambda key, item: item + 1
+        r(['4', '--backend', 'serial'])
+        self.assertEquals(100, len(r.result_store))
+    
+    @unittest.skipIf(asyncio is None, 'asyncio not available')
+    def testAsyncioBackend(self):
+        for num_procs in ('10', '1'):
+            r = BasicRunner()
+            r.proc = lambda key, item: asyncio.sleep(0.001, result=item + 1)
+            r([num_procs, '--backend', 'asyncio'])
+            self.assertEquals(100, len(r.result_store))
+            
+            for k, v in r.result_store.items():
+                self.assertEquals(k, v - 1)
+
+    def testWorkerPool(self):
+        with WorkerPool(3, ['json']) as pool:
+            for runner, args in ((BasicRunner, ['1']), 
+                                 (BasicRunner, ['1', '--mapper_per_item']),
+                                 (BatchRunner, ['1', '--batch_size', '7'])):
+                r = runner()
+                r(args, pool)
+                self.assertEquals(100, len(r.result_store))
+            
+            r = CountRunner()
+            r(['1'], pool)
+            self.assertEquals(dict((k, 100) for k in xrange(10)), 
+                              r.result_store)
+            
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                path = os.path.join(tmp_dir, 'checkpoint')
+                r = CheckpointRunner()
+                r(['1', '--checkpoint', path], pool)
+                self.assertEquals(100, len(r.reduc.store))
+            finally:
+                shutil.rmtree(tmp_dir)
+    
+    def testWorkerPoolFailedRun(self):
+        #the tasks of a failed run are not mapped before the next ones
+        with WorkerPool(3) as pool:
+            r = BasicRunner()
+            r.igen = ((i, i) for i in xrange(20000))
+            r.proc = SlowFailingProcessor(50)
+            self.assertFalse(r(['1'], pool))
+            
+            r = BasicRunner()
+            start = time.time()
+            self.assertTrue(r(['1'], pool))
+            self.assertTrue(time.time() - start < 0.5)
+            self.assertEquals(100, len(r.result_store))
+
+    def testFailures(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'quarantine')
+            for runner, args in ((CheckpointRunner, ['4']), 
+                                 (CheckpointRunner, ['1']),
+                                 (CheckpointRunner, ['4', '--spill_after', 
+                                                     '10']),
+                                 (BatchFailingRunner, ['4'])):
+                r = runner(fail_key = 50)
+                self.assertTrue(r(args + ['--retries', '2', 
+                                          '--quarantine', path]))
+                self.assertEquals(99, len(r.reduc.store))
+                self.assertFalse(50 in r.reduc.store)
+                
+                quarantined = list(read_quarantine(path))
+                os.remove(path)
+                self.assertEquals(1, len(quarantined))
+                self.assertEquals((50, 50), quarantined[0][:2])
+                self.assertTrue('ValueError' in quarantined[0][2])
+            
+            r = CheckpointRunner(fail_key = 50)
+            self.assertFalse(r(['4', '--max_failures', '0']))
+            
+            r = CheckpointRunner(fail_key = 50)
+            self.assertTrue(r(['4', '--max_failures', '1']))
+            self.assertEquals(99, len(r.reduc.store))
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def testRetries(self):
+        for args in (['4'], ['1']):
+            r = BasicRunner()
+            r.proc = FlakyProcessor()
+            self.assertTrue(r(args + ['--retries', '1', 
+                                      '--max_failures', '0']))
+            self.assertEquals(100, len(r.result_store))
+    
+    def testFailuresPartitioned(self):
+        r = PartitionRunner()
+        r.proc = FailingProcessor(50)
+        self.assertTrue(r(['4', '--num_reducers', '2', '--max_failures', '1']))
+        self.assertEquals(99, len(r.result_store))
+        
+        r = CountRunner()
+        r.mapper = lambda: FailingProcessor(5)
+        self.assertTrue(r(['4', '--max_failures', '100']))
+        self.assertEquals(9, len(r.result_store))
+        
+        #a failed reducer does not block the mappers, even once the pipe
+        #of its partition is full
+        for num_procs in ('4', '1'):
+            r = FailingPartitionRunner()
+            r.igen = ((i, i) for i in xrange(200000))
+            start = time.time()
+            self.assertFalse(r([num_procs, '--num_reducers', '2']))
+            self.assertTrue(time.time() - start < 30)
+
+    def testReplaceWorkers(self):
+        for args in (['4', '--max_tasks_per_worker', '2'],
+                     ['4', '--max_tasks_per_worker', '2', '--batch_size', '3'],
+                     ['4', '--max_worker_memory', '1']):
+            r = BasicRunner()
+            self.assertTrue(r(args))
+            self.assertEquals(100, len(r.result_store))
+            
+            for k, v in r.result_store.items():
+                self.assertEquals(k, v - 1)
+        
+        #without /proc, only the memory limit cannot be used
+        #the staticmethod itself is restored, not the function it wraps
+        available = _MemoryMonitor.__dict__['available']
+        _MemoryMonitor.available = staticmethod(lambda: False)
+        try:
+            r = BasicRunner()
+            self.assertTrue(r(['4', '--max_tasks_per_worker', '2']))
+            self.assertEquals(100, len(r.result_store))
+            
+            r = BasicRunner()
+            self.assertFalse(r(['4', '--max_worker_memory', '1']))
+        finally:
+            _MemoryMonitor.available = available
+
+    def testSharedArrays(self):
+        share_dir = tempfile.mkdtemp()
+        try:
+            for args, shared in ((['4'], True), 
+                                 (['4', '--stats'], True),
+                                 (['4', '--mapper_per_item'], True),
+                                 (['1'], False)):
+                r = BasicRunner()
+                r.proc = ArrayProcessor()
+                self.assertTrue(r(args + ['--share_arrays_above', '800',
+                                          '--share_dir', share_dir]))
+                self.assertEquals(100, len(r.result_store))
+                for k, v in r.result_store.items():
+                    self.assertEquals(shared, isinstance(v, np.memmap))
+                    self.assertTrue((np.arange(100) + k == v).all())
+                self.assertEquals([], os.listdir(share_dir))
+            
+            #arrays below the threshold are pickled
+            r = BasicRunner()
+            r.proc = ArrayProcessor()
+            self.assertTrue(r(['4', '--share_arrays_above', '801']))
+            self.assertFalse(any(isinstance(v, np.memmap) 
+                                 for v in r.result_store.values()))
+            
+            r = PartitionRunner()
+            r.proc = ArrayProcessor()
+            self.assertTrue(r(['4', '--num_reducers', '2', 
+                               '--share_arrays_above', '800']))
+            self.assertEquals(100, len(r.result_store))
+            for k, v in r.result_store.items():
+                self.assertTrue((np.arange(100) + k == v).all())
+            
+            #combined values are shared
+            r = CountRunner()
+            r.mapper = lambda: ArrayProcessor()
+            self.assertTrue(r(['4', '--share_arrays_above', '800']))
+            self.assertEquals(10, len(r.result_store))
+            for k, v in r.result_store.items():
+                self.assertTrue((100 * np.arange(100) + 
+                                 sum(xrange(k, 1000, 10)) == v).all())
+        finally:
+            shutil.rmtree(share_dir)
+
+    def testOrdered(self):
+        for args in (['4', '--ordered'],
+                     ['4', '--ordered', '--chunk_size', '7'],
+                     ['4', '--ordered', '--chunk_size', '7', 
+                      '--reorder_buffer', '1'],
+                     ['4', '--ordered', '--batch_size', '3'],
+                     ['4', '--ordered', '--backend', 'thread']):
+            r = OrderRunner()
+            r.proc = SlowProcessor()
+            self.assertTrue(r(args))
+            self.assertEquals(list(reversed(xrange(100))), r.keys)
+        
+        r = PartitionRunner()
+        self.assertFalse(r(['4', '--ordered', '--num_reducers', '2']))
+
+    def testInputSplits(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for split in xrange(7):
+                path = os.path.join(tmp_dir, 'split-%d.gz' % split)
+                with gzip.open(path, 'wb') as split_file:
+                    for i in xrange(split, 100, 7):
+                        split_file.write(b'%d\n' % i)
+                paths.append(path)
+            
+            for args in (['4'], ['4', '--backend', 'thread'], ['1'],
+                         ['4', '--backend', 'serial'], 
+                         ['4', '--batch_size', '3'],
+                         ['4', '--num_reducers', '2'],
+                         ['4', '--share_arrays_above', '0']):
+                r = SplitRunner(paths)
+                self.assertTrue(r(args))
+                self.assertEquals(100, len(r.reduc.store))
+                for k, v in r.reduc.store.items():
+                    self.assertEquals(k, v - 1)
+            
+            r = SplitRunner(paths)
+            r.proc = FailingProcessor(50)
+            self.assertTrue(r(['4', '--max_failures', '1']))
+            self.assertEquals(99, len(r.reduc.store))
+            
+            r = SplitRunner(paths)
+            r.proc = FailingProcessor(50)
+            self.assertFalse(r(['4']))
+            self.assertFalse(SplitRunner(paths)(['4', '--ordered']))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _run_remote(self, runner, args, num_slaves = 2):
+        '''Runs with the remote backend and slaves in this machine'''
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        
+        slaves = [Process(target=run_worker, 
+                          args=(('localhost', port), 'secret', 1, 10))
+                  for _ in range(num_slaves)]
+        for slave in slaves:
+            slave.start()
+        try:
+            return runner(args + ['--backend', 'remote', '--authkey', 
+                                  'secret', '--coordinator', 
+                                  'localhost:%d' % port])
+        finally:
+            for slave in slaves:
+                slave.join()
+    
+    def testPicklableInitargs(self):
+        #spawned slaves receive pickled initargs, the runner (here with a
+        #generator and a closure) is only sent with input splits
+        process_pool = _POOLS['process']
+        _POOLS['process'] = PicklingPool
+        try:
+            for args in (['4'], ['4', '--batch_size', '7']):
+                r = BasicRunner()
+                self.assertTrue(r(args))
+                self.assertEquals(100, len(r.result_store))
+        finally:
+            _POOLS['process'] = process_pool
+
+    def testRemoteBackend(self):
+        for args in (['2'], ['2', '--chunk_size', '7'], ['1', '--stats']):
+            r = BasicRunner()
+            self.assertTrue(self._run_remote(r, args))
+            self.assertEquals(100, len(r.result_store))
+            for k, v in r.result_store.items():
+                self.assertEquals(k, v - 1)
+        
+        r = OrderRunner()
+        self.assertTrue(self._run_remote(r, ['2', '--ordered'], 3))
+        self.assertEquals(list(reversed(xrange(100))), r.keys)
+        
+        r = CountRunner()
+        self.assertTrue(self._run_remote(r, ['2']))
+        self.assertEquals(dict((i, 100) for i in xrange(10)), 
+                          r.result_store)
+        
+        r = BasicRunner()
+        r.proc = FailingProcessor(50)
+        self.assertFalse(self._run_remote(r, ['2']))
+    
+    def testRemoteLostSlave(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            r = BasicRunner()
+            r.proc = DyingProcessor(os.path.join(tmp_dir, 'died'))
+            self.assertTrue(self._run_remote(r, ['2', '--chunk_size', '5']))
+            self.assertEquals(100, len(r.result_store))
+            self.assertTrue(os.path.exists(r.proc.path))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testProgress(self):
+        for runner, args in ((BasicRunner, ['4']), 
+                             (BasicRunner, ['4', '--chunk_size', '7']),
+                             (BasicRunner, ['1']),
+                             (BatchRunner, ['4']), 
+                             (PartitionRunner, ['4', '--num_reducers', '2']),
+                             (PartitionRunner, ['1', '--num_reducers', '2'])):
+            r = runner()
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            try:
+                self.assertTrue(r(args + ['--progress', '--total_items', 
+                                          '100']))
+                lines = sys.stderr.getvalue().splitlines()
+            finally:
+                sys.stderr = stderr
+            
+            self.assertEquals(100, len(r.result_store))
+            last = [line for line in lines if line.startswith('Progress')]
+            self.assertTrue(last[-1].startswith('Progress: 100 items of '
+                                                '100 (100.0%)'))
+
+    def testSpeculate(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for i, args in enumerate((['4'], ['4', '--chunk_size', '3'],
+                                      ['4', '--stats', '--batch_size', '5'],
+                                      ['4', '--backend', 'thread'])):
+                #items are sent in chunks of 100 by default
+                r = OrderRunner()
+                r.igen = ((i, i) for i in reversed(xrange(1000)))
+                r.proc = StragglerProcessor(os.path.join(tmp_dir, str(i)))
+                start = time.time()
+                self.assertTrue(r(args + ['--speculate', '3']))
+                self.assertTrue(time.time() - start < 5)
+                
+                #the copy of the straggler was reduced, only once
+                self.assertTrue(os.path.exists(r.proc.path))
+                self.assertEquals(1000, len(r.keys))
+                self.assertEquals(1000, len(r.result_store))
+                for k, v in r.result_store.items():
+                    self.assertEquals(k, v - 1)
+        finally:
+            shutil.rmtree(tmp_dir)
+        
+        r = PartitionRunner()
+        self.assertFalse(r(['4', '--speculate', '3', '--num_reducers', '2']))
+        
+        #results which cannot be sent back fail the run
+        for args in (['4'], ['4', '--speculate', '3']):
+            r = BasicRunner()
+            r.proc = UnpicklableProcessor()
+            self.assertFalse(r(args))
+
+    def testCache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            args = ['1', '--cache_dir', tmp_dir]
+            r = BasicRunner()
+            r.proc = CountingProcessor()
+            self.assertTrue(r(args))
+            self.assertEquals(100, r.proc.calls)
+            
+            #a new item and a changed one are mapped
+            r = BasicRunner()
+            r.proc = CountingProcessor()
+            r.igen = ((i, i + (i == 7)) for i in xrange(101))
+            self.assertTrue(r(args))
+            self.assertEquals(2, r.proc.calls)
+            self.assertEquals(101, len(r.result_store))
+            self.assertEquals(9, r.result_store[7])
+            
+            r = BasicRunner()
+            r.proc = CountingProcessor()
+            r.proc.version = 2
+            self.assertTrue(r(args))
+            self.assertEquals(100, r.proc.calls)
+            
+            #parameters of the mapper are part of the key
+            r = BasicRunner()
+            r.proc = ScaleProcessor(2)
+            self.assertTrue(r(args))
+            r = BasicRunner()
+            r.proc = ScaleProcessor(1000)
+            self.assertTrue(r(args))
+            self.assertEquals(1000 * 99, r.result_store[99])
+            
+            r = BasicRunner()
+            r.proc = lambda key, item: item * 100
+            self.assertFalse(r(args))
+            
+            r = BatchRunner()
+            self.assertTrue(r(args))
+            self.assertEquals([100], r.proc.batch_sizes)
+            
+            r = BatchRunner()
+            self.assertTrue(r(args))
+            self.assertEquals([], r.proc.batch_sizes)
+            
+            for extra in (['--chunk_size', '7'], ['--batch_size', '7']):
+                r = BatchRunner()
+                self.assertTrue(r(['4', '--cache_dir', tmp_dir] + extra))
+                self.assertEquals(100, len(r.result_store))
+                for k, v in r.result_store.items():
+                    self.assertEquals(k, v - 1)
+            
+            def cache_size():
+                return sum(len(file_names) 
+                           for _, _, file_names in os.walk(tmp_dir))
+            self.assertEquals(502, cache_size())
+            
+            r = BasicRunner()
+            self.assertTrue(r(args + ['--cache_max_bytes', '100']))
+            self.assertTrue(0 < cache_size() < 100)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+class ProgressTest(unittest.TestCase):
+    '''Tests the _Progress class'''
+    
+    def testCount(self):
+        progress = _Progress(100, every = 0.01)
+        progress.start()
+        tasks = progress.track([[1, 2], [3], [4, 5, 6]])
+        self.assertEquals(3, len(list(progress.tracked(tasks))))
+        self.assertEquals(6, progress.done)
+        
+        self.assertEquals(4, len(list(progress.count(xrange(4)))))
+        progress.add(40)
+        self.assertEquals(50, progress.done)
+        time.sleep(0.05)
+        progress.stop()
+        
+        line = progress.line()
+        self.assertTrue(line.startswith('Progress: 50 items of 100 (50.0%)'))
+        self.assertTrue('ETA 0:00:0' in line)
+        
+        self.assertFalse('ETA' in _Progress().line())
+    
+    def testEstimateLines(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(tmp_dir, 'plain'), 
+                     os.path.join(tmp_dir, 'plain2')]
+            for path in paths:
+                with open(path, 'w') as lines_file:
+                    for i in xrange(1000):
+                        lines_file.write('%09d\n' % i)
+            self.assertEquals(2000, estimate_lines(paths, 100))
+            self.assertEquals(0, estimate_lines([]))
+            
+            path = os.path.join(tmp_dir, 'lines.gz')
+            with gzip.open(path, 'wb') as lines_file:
+                for i in xrange(100000):
+                    lines_file.write(b'%09d\n' % random.randint(0, 1e9))
+            estimate = estimate_lines([path, path], 10000)
+            self.assertTrue(100000 < estimate < 400000)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+class ReorderBufferTest(unittest.TestCase):
+    '''Tests the _ReorderBuffer class'''
+    
+    def testOrder(self):
+        pool = ThreadPool(4)
+        try:
+            reorder = _ReorderBuffer(5)
+            tasks = ((i, i) for i in xrange(100))
+            results = reorder.imap(pool.imap_unordered, _sleep_helper, tasks)
+            self.assertEquals(list(xrange(100)), list(results))
+            self.assertTrue(0 < reorder.peak <= 5)
+        finally:
+            pool.close()
+            pool.join()
+    
+    def testClose(self):
+        pool = ThreadPool(2)
+        try:
+            reorder = _ReorderBuffer(2)
+            results = reorder.imap(pool.imap_unordered, _sleep_helper, 
+                                   ((i, i) for i in xrange(100)))
+            self.assertEquals(0, next(results))
+            reorder.close()
+        finally:
+            pool.close()
+            pool.join()
+
+def _sleep_helper(tup):
+    '''Returns the key after sleeping a random time'''
+    key, item = tup
+    time.sleep(random.random() / 1000)
+    return key
+
+class RecyclingPoolTest(unittest.TestCase):
+    '''Tests the _RecyclingPool class'''
+    
+    def testRecycle(self):
+        pools = []
+        def make_pool():
+            pools.append(Pool(2, _install_mapper, (Processor(),)))
+            return pools[-1]
+        
+        #every process is always over the limit
+        monitor = _MemoryMonitor(max_mb = 1e-6, every = 0)
+        pool = _RecyclingPool(make_pool, monitor, 2)
+        try:
+            results = pool.imap(_processor_helper, 
+                                ((i, i) for i in xrange(10)), 2)
+            self.assertEquals([(i, i + 1) for i in xrange(10)], list(results))
+            self.assertTrue(len(pools) > 1)
+            self.assertTrue(len(monitor.peaks) > 2)
+            self.assertTrue(all(peak > 0 for peak in monitor.peaks.values()))
+        finally:
+            pool.close()
+            pool.join()
+
+class SpeculativePoolTest(unittest.TestCase):
+    '''Tests the _SpeculativePool class'''
+    
+    def testWindow(self):
+        pool = _SpeculativePool(None, 2, 3, window = 5)
+        for duration in (9, 1, 8, 2, 7, 3, 6, 4):
+            pool._add_duration(duration)
+        
+        #only the last 5 durations are kept, sorted for the median
+        self.assertEquals([2, 3, 4, 6, 7], pool._durations)
+
+class PipelineTest(unittest.TestCase):
+    '''Tests the Pipeline class'''
+    
+    def testStages(self):
+        for overlap in (False, True):
+            first = EmitRunner()
+            second = CountRunner()
+            pipeline = Pipeline([first, second], overlap, buffer_size = 5)
+            self.assertTrue(pipeline([['4'], ['2', '--batch_size', '7']]))
+            
+            #second stage counts the values of the first one by key % 10
+            self.assertEquals(100, len(first.result_store))
+            self.assertEquals(dict((k, 10) for k in xrange(10)), 
+                              second.result_store)
+    
+    def testOverlappedThreads(self):
+        #each stage must map with its own mapper
+        for _ in range(5):
+            first = EmitRunner()
+            first.proc = lambda key, item: item + 1
+            second = CountRunner()
+            pipeline = Pipeline([first, second], True, buffer_size = 5)
+            self.assertTrue(pipeline([['4', '--backend', 'thread'], 
+                                      ['4', '--backend', 'thread']]))
+            
+            self.assertEquals(dict((k, k + 1) for k in xrange(100)), 
+                              first.result_store)
+            self.assertEquals(dict((k, 10) for k in xrange(10)), 
+                              second.result_store)
+    
+    def testFailedStage(self):
+        for overlap in (False, True):
+            first = EmitRunner()
+            first.proc = FailingProcessor(50)
+            second = CountRunner()
+            pipeline = Pipeline([first, second], overlap, buffer_size = 5)
+            self.assertFalse(pipeline([['1'], ['1']]))
+            
+            first = EmitRunner()
+            second = CountRunner()
+            second.mapper = lambda: FailingProcessor(3)
+            pipeline = Pipeline([first, second], overlap, buffer_size = 5)
+            self.assertFalse(pipeline([['1'], ['1']]))
+
+class ExternalSorterTest(unittest.TestCase):
+    '''Tests the _ExternalSorter class'''
+    
+    def testSortedItems(self):
+        for max_items in (1, 3, 100):
+            sorter = _ExternalSorter(max_items)
+            for i in xrange(20):
+                sorter(i % 5, [i])
+            
+            result = list(sorter.sorted_items())
+            expected = [(k, [i]) for k in xrange(5) for i in xrange(k, 20, 5)]
+            self.assertEquals(expected, result)
+            sorter.close()
+
+class ChunkSizeTunerTest(unittest.TestCase):
+    '''Tests the _ChunkSizeTuner class'''
+    
+    def testTrack(self):
+        tuner = _ChunkSizeTuner(target_time = 1, alpha = 1)
+        self.assertEquals(1, tuner.chunk_size)
+        
+        #no more than max_pending chunks before their results
+        chunks = tuner.chunks(((i, i) for i in xrange(100)), 2)
+        first = [next(chunks), next(chunks)]
+        self.assertEquals([[(0, 0)], [(1, 1)]], first)
+        
+        results = tuner.track(iter([(1, 0.1, [(0, 1)])]))
+        self.assertEquals([(0, 1)], next(results))
+        self.assertTrue(tuner.item_bytes > 0)
+        self.assertEquals(10, tuner.chunk_size)
+        self.assertEquals(10, len(next(chunks)))
+        
+        tuner.close()
+        self.assertEquals([], list(chunks))
+    
+    def testUpdate(self):
+        tuner = _ChunkSizeTuner(target_time = 1, alpha = 1)
+        tuner.update(10, 1)
+        self.assertEquals(10, tuner.chunk_size)
+        
+        tuner.update(10, 10)
+        self.assertEquals(1, tuner.chunk_size)
+        
+        tuner.update(100, 1e-6)
+        self.assertEquals(10000, tuner.chunk_size)
+        
+        tuner.item_bytes = 2 ** 10
+        tuner.update(100, 1e-6)
+        self.assertEquals(1024, tuner.chunk_size)
+    
+    def testChunks(self):
+        tuner = _ChunkSizeTuner()
+        tuner.chunk_size = 3
+        chunks = tuner.chunks((i, i) for i in xrange(10))
+        self.assertEquals(3, len(next(chunks)))
+        
+        tuner.chunk_size = 5
+        self.assertEquals([5, 2], [len(c) for c in chunks])
+
+class InFlightLimiterTest(unittest.TestCase):
+    '''Tests the _InFlightLimiter class'''
+    
+    def testLimits(self):
+        limiter = _InFlightLimiter(max_items = 10)
+        tasks = limiter.throttle([[1] * 5] * 4)
+        next(tasks)
+        next(tasks)
+        self.assertEquals(10, limiter.items)
+        
+        limiter.release()
+        next(tasks)
+        self.assertEquals(10, limiter.items)
+        self.assertEquals(10, limiter.peak_items)
+        
+        limiter.close()
+        self.assertEquals([], list(tasks))
+    
+    def testLargeTask(self):
+        limiter = _InFlightLimiter(max_bytes = 1)
+        tasks = limiter.throttle([[1] * 100] * 2)
+        next(tasks)
+        self.assertTrue(limiter.bytes > 1)
+        self.assertEquals(limiter.bytes, limiter.peak_bytes)
+        
+        limiter.release()
+        self.assertEquals(0, limiter.bytes)
+        next(tasks)
+
 class Processor(BaseMapper):
     
     def _map(self, key, item):
@@ -70,4 +951,270 @@ class BasicRunner(Runner):
         return self.proc 
     
     def reducer(self):
-        return self.reduc
\ No newline at end of file
+        return self.reduc
+
+class Counter(BaseMapper):
+    
+    def _map(self, key, item):
+        return 1
+
+class Summer(BaseCombiner):
+    
+    def _combine(self, key, values):
+        return sum(values)
+
+class CountRunner(Runner):
+    
+    def __init__(self):
+        super(CountRunner, self).__init__('Count', 'Blah')
+        self.result_store = {}
+        self.num_reduced = 0
+    
+    def item_generator(self):
+        return ((i % 10, i) for i in xrange(1000))
+    
+    def mapper(self):
+        return Counter()
+    
+    def combiner(self):
+        return Summer()
+    
+    def reducer(self):
+        def _reduc(key, value):
+            self.num_reduced += 1
+            self.result_store[key] = self.result_store.get(key, 0) + value
+        return _reduc
+
+class BatchProcessor(BaseBatchMapper):
+    
+    stack_items = True
+    
+    def __init__(self):
+        self.batch_sizes = []
+    
+    def _map_batch(self, keys, items):
+        self.batch_sizes.append(len(keys))
+        return items + 1
+
+class BatchRunner(BasicRunner):
+    
+    def __init__(self):
+        super(BatchRunner, self).__init__()
+        self.proc = BatchProcessor()
+
+class ArrayProcessor(BaseMapper):
+    
+    def _map(self, key, item):
+        return np.arange(100, dtype='d') + item
+
+class DictReducer(BaseReducer):
+    
+    def __init__(self):
+        self.store = {}
+    
+    def _reduce(self, key, value):
+        self.store[key] = value
+
+class FailingReducer(DictReducer):
+    
+    def __init__(self, fail_key):
+        super(FailingReducer, self).__init__()
+        self.fail_key = fail_key
+    
+    def _reduce(self, key, value):
+        if key == self.fail_key:
+            raise ValueError('Cannot reduce %s' % key)
+        super(FailingReducer, self)._reduce(key, value)
+
+class PartitionRunner(BasicRunner):
+    
+    def __init__(self):
+        super(PartitionRunner, self).__init__()
+        self.partition_sizes = []
+    
+    def reducer(self):
+        return DictReducer()
+    
+    def merge_partitions(self, states):
+        for reducer in states:
+            self.partition_sizes.append(len(reducer.store))
+            self.result_store.update(reducer.store)
+
+class FailingPartitionRunner(PartitionRunner):
+    
+    def reducer(self):
+        return FailingReducer(3)
+
+class OrderRunner(BasicRunner):
+    
+    def __init__(self):
+        super(OrderRunner, self).__init__()
+        self.igen = ((i, i) for i in reversed(xrange(100)))
+        self.keys = []
+        
+        def _reduc(key, value): 
+            self.keys.append(key)
+            self.result_store[key] = value
+        self.reduc = _reduc
+
+class SplitRunner(Runner):
+    
+    def __init__(self, paths):
+        super(SplitRunner, self).__init__('Split', 'Blah')
+        self.paths = paths
+        self.proc = Processor()
+        self.reduc = DictReducer()
+    
+    def input_splits(self):
+        return self.paths
+    
+    def read_split(self, split):
+        with gzip.open(split, 'rb') as split_file:
+            for line in split_file:
+                yield int(line), int(line)
+    
+    def item_generator(self):
+        raise AssertionError('Splits are read by the slaves')
+    
+    def mapper(self):
+        return self.proc
+    
+    def reducer(self):
+        return self.reduc
+    
+    def merge_partitions(self, states):
+        for reducer in states:
+            self.reduc.store.update(reducer.store)
+
+class DyingProcessor(BaseMapper):
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def _map(self, key, item):
+        #the first process to map key 50 exits
+        if key == 50 and not os.path.exists(self.path):
+            open(self.path, 'w').close()
+            os._exit(1)
+        return item + 1
+
+class StragglerProcessor(BaseMapper):
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def _map(self, key, item):
+        #the first process to map key 50 is a straggler
+        if key == 50 and not os.path.exists(self.path):
+            open(self.path, 'w').close()
+            time.sleep(10)
+        time.sleep(0.001)
+        return item + 1
+
+class CountingProcessor(BaseMapper):
+    
+    def __init__(self):
+        self.calls = 0
+    
+    def _map(self, key, item):
+        self.calls += 1
+        return item + 1
+
+class ScaleProcessor(BaseMapper):
+    
+    def __init__(self, factor):
+        self.factor = factor
+    
+    def _map(self, key, item):
+        return item * self.factor
+
+class PicklingPool(BasePool):
+    '''Pool which pickles its initargs, as spawned processes do'''
+    
+    def __init__(self, processes, initializer, initargs):
+        pickle.dumps(initargs)
+        super(PicklingPool, self).__init__(processes, initializer, initargs)
+
+class UnpicklableProcessor(BaseMapper):
+    
+    def _map(self, key, item):
+        if key == 50:
+            return threading.Lock()
+        return item + 1
+
+class SlowProcessor(BaseMapper):
+    
+    def _map(self, key, item):
+        time.sleep(random.random() / 1000)
+        return item + 1
+
+class FailingProcessor(BaseMapper):
+    
+    def __init__(self, fail_key):
+        self.fail_key = fail_key
+    
+    def _map(self, key, item):
+        if key == self.fail_key:
+            raise ValueError('Failing at %d' % key)
+        return item + 1
+class SlowFailingProcessor(FailingProcessor):
+    
+    def _map(self, key, item):
+        time.sleep(0.002)
+        return super(SlowFailingProcessor, self)._map(key, item)
+
+class CheckpointRunner(BasicRunner):
+    
+    def __init__(self, fail_key = None):
+        super(CheckpointRunner, self).__init__()
+        self.proc = FailingProcessor(fail_key)
+        self.reduc = DictReducer()
+        self.num_reduced = 0
+    
+    def reducer(self):
+        def _reduc(key, value):
+            self.num_reduced += 1
+            self.reduc(key, value)
+        return _reduc
+    
+    def checkpoint_state(self, reducer):
+        return self.reduc
+    
+    def restore_state(self, state):
+        self.reduc = state
+        return self.reducer()
+
+class EmitRunner(BasicRunner):
+    
+    def reducer(self):
+        def _reduc(key, value):
+            self.result_store[key] = value
+            self.emit(key % 10, value)
+        return _reduc
+
+class FlakyProcessor(BaseMapper):
+    
+    def __init__(self):
+        self.seen = set()
+    
+    def _map(self, key, item):
+        if key not in self.seen:
+            self.seen.add(key)
+            raise ValueError('First try of %d' % key)
+        return item + 1
+
+class BatchFailingProcessor(BaseBatchMapper):
+    
+    def __init__(self, fail_key):
+        self.fail_key = fail_key
+    
+    def _map_batch(self, keys, items):
+        if self.fail_key in keys:
+            raise ValueError('Failing at %d' % self.fail_key)
+        return [item + 1 for item in items]
+
+class BatchFailingRunner(CheckpointRunner):
+    
+    def __init__(self, fail_key = None):
+        super(BatchFailingRunner, self).__init__()
+        self.proc = BatchFailingProcessor(fail_key)
\ No newline at end of file